@@ -0,0 +1,223 @@
+"""
+Local pub/sub between the worker processes of one deployment. A single
+leader, elected through a lock file, owns MQTT ingestion and publishes what
+it commits, every worker (the leader included) receives the messages and
+feeds its own WebSocket clients.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import os
+import struct
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from contextlib import ExitStack, suppress
+from os import environ as env
+from typing import IO
+
+WORKERS = int(env.get("WORKERS", "1"))
+BROKER_SOCKET = env.get("BROKER_SOCKET", "broker.sock")
+
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5.0
+
+# Peers with more than this many unsent bytes are disconnected
+MAX_PEER_BUFFER = 16 * 1024 * 1024
+
+# (topic length, payload length), followed by the topic and the payload
+FRAME_HEADER = struct.Struct("<HI")
+
+MessageHandler = Callable[[bytes], None]
+
+
+class Broker(ABC):
+	"""Topic based pub/sub, delivering to local subscribers synchronously"""
+
+	def __init__(self) -> None:
+		self.handlers: dict[str, list[MessageHandler]] = {}
+		self.leader = False
+
+	def subscribe(self, topic: str, handler: MessageHandler) -> None:
+		self.handlers.setdefault(topic, []).append(handler)
+
+	def dispatch(self, topic: str, payload: bytes) -> None:
+		for handler in self.handlers.get(topic, ()):
+			try:
+				handler(payload)
+			except Exception as e:
+				print(f"Failed to handle broker message on {topic}: {e}")
+
+	@abstractmethod
+	def publish(self, topic: str, payload: bytes) -> None: ...
+
+	@abstractmethod
+	def start(self, on_leader: Callable[[], None]) -> None:
+		"""Start the broker, `on_leader` runs once this process becomes leader."""
+
+	async def stop(self) -> None:
+		pass
+
+
+class InProcessBroker(Broker):
+	"""Broker for a single worker, which is always the leader"""
+
+	def publish(self, topic: str, payload: bytes) -> None:
+		self.dispatch(topic, payload)
+
+	def start(self, on_leader: Callable[[], None]) -> None:
+		self.leader = True
+		on_leader()
+
+
+def encode_frame(topic: str, payload: bytes) -> bytes:
+	encoded = topic.encode()
+	return FRAME_HEADER.pack(len(encoded), len(payload)) + encoded + payload
+
+
+class UnixSocketBroker(Broker):
+	"""
+	Broker shared by the workers of one host through a Unix socket. The worker
+	holding the lock file serves the socket and relays every frame to all the
+	other workers. The others connect to it, and race for the lock whenever
+	the connection drops so a new leader takes over if the old one exits.
+	"""
+
+	def __init__(self, path: str = BROKER_SOCKET) -> None:
+		super().__init__()
+		self.path = path
+		self.lock_file: IO[str] | None = None
+		self.peers: set[asyncio.StreamWriter] = set()
+		self.upstream: asyncio.StreamWriter | None = None
+		self.on_leader: Callable[[], None] = lambda: None
+		self.task: asyncio.Task[None] | None = None
+
+	def try_lock(self) -> bool:
+		# The file is closed on failure, and kept open while holding the lock
+		with ExitStack() as stack:
+			lock_file = stack.enter_context(open(f"{self.path}.lock", "a"))
+			try:
+				fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				return False
+
+			stack.pop_all()
+			self.lock_file = lock_file
+			return True
+
+	def promote(self) -> None:
+		print(f"Worker {os.getpid()} is the broker leader")
+		self.leader = True
+		self.on_leader()
+
+	def start(self, on_leader: Callable[[], None]) -> None:
+		self.on_leader = on_leader
+		if self.try_lock():
+			self.promote()
+		self.task = asyncio.create_task(self.run())
+
+	async def stop(self) -> None:
+		if self.task is not None:
+			self.task.cancel()
+			with suppress(asyncio.CancelledError):
+				await self.task
+			self.task = None
+
+		for writer in [*self.peers, *filter(None, [self.upstream])]:
+			writer.close()
+		self.peers.clear()
+		self.upstream = None
+
+		if self.lock_file is not None:
+			with suppress(FileNotFoundError):
+				os.unlink(self.path)
+			self.lock_file.close()
+			self.lock_file = None
+			self.leader = False
+
+	async def run(self) -> None:
+		delay = RECONNECT_MIN_DELAY
+		while not self.leader:
+			try:
+				reader, writer = await asyncio.open_unix_connection(self.path)
+			except OSError:
+				pass
+			else:
+				self.upstream = writer
+				delay = RECONNECT_MIN_DELAY
+				try:
+					await self.read_frames(reader, None)
+				except (asyncio.IncompleteReadError, ConnectionError):
+					print("Lost connection to the broker leader")
+				finally:
+					self.upstream = None
+					writer.close()
+
+			if self.try_lock():
+				self.promote()
+			else:
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+		# A previous leader may have left its socket file behind
+		with suppress(FileNotFoundError):
+			os.unlink(self.path)
+
+		server = await asyncio.start_unix_server(self.handle_peer, self.path)
+		async with server:
+			await server.serve_forever()
+
+	async def handle_peer(
+		self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+	) -> None:
+		self.peers.add(writer)
+		try:
+			await self.read_frames(reader, writer)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self.peers.discard(writer)
+			writer.close()
+
+	async def read_frames(
+		self, reader: asyncio.StreamReader, source: asyncio.StreamWriter | None
+	) -> None:
+		while True:
+			header = await reader.readexactly(FRAME_HEADER.size)
+			topic_size, payload_size = FRAME_HEADER.unpack(header)
+			topic = (await reader.readexactly(topic_size)).decode()
+			payload = await reader.readexactly(payload_size)
+
+			if self.leader:
+				self.relay(encode_frame(topic, payload), source)
+			self.dispatch(topic, payload)
+
+	def relay(self, frame: bytes, source: asyncio.StreamWriter | None) -> None:
+		for writer in list(self.peers):
+			if writer is source:
+				continue
+
+			if writer.transport.get_write_buffer_size() > MAX_PEER_BUFFER:
+				print("Disconnecting broker peer that stopped reading")
+				self.peers.discard(writer)
+				writer.close()
+				continue
+
+			writer.write(frame)
+
+	def publish(self, topic: str, payload: bytes) -> None:
+		if self.leader:
+			self.relay(encode_frame(topic, payload), None)
+		elif self.upstream is not None:
+			self.upstream.write(encode_frame(topic, payload))
+		else:
+			print(f"Not connected to the broker leader, {topic} only delivered locally")
+
+		self.dispatch(topic, payload)
+
+
+def create_broker() -> Broker:
+	if WORKERS > 1:
+		return UnixSocketBroker()
+	return InProcessBroker()
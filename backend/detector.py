@@ -0,0 +1,170 @@
+"""
+Streaming fire hazard detection over the raw sensor readings. Every reading
+goes through threshold, rate-of-rise and anomaly rules in constant time,
+before it is queued for the database, so alerts don't wait for a flush.
+"""
+
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from datetime import datetime
+from os import environ as env
+from typing import TYPE_CHECKING, Literal
+
+from backend.ring_buffer import to_timestamp
+
+if TYPE_CHECKING:
+	from backend.ring_buffer import SensorWindow
+
+ALERT_TEMPERATURE = float(env.get("ALERT_TEMPERATURE", "70"))
+ALERT_GAS = float(env.get("ALERT_GAS", "800"))
+
+# Rise per minute of the smoothed signal, 8.3 °C/min is the usual
+# rate-of-rise heat detector setting
+RISE_TEMPERATURE = float(env.get("RISE_TEMPERATURE", "8.3"))
+RISE_GAS = float(env.get("RISE_GAS", "300"))
+
+# Smoothing factor of the moving averages, and how many standard deviations
+# from the moving mean count as an anomaly
+EWMA_ALPHA = float(env.get("EWMA_ALPHA", "0.1"))
+ANOMALY_SIGMAS = float(env.get("ANOMALY_SIGMAS", "4"))
+
+# Readings needed before the moving statistics are trusted
+WARMUP_READINGS = 20
+
+SensorField = Literal["temperature", "gas"]
+AlertKind = Literal["threshold", "rate_of_rise", "anomaly"]
+
+
+@dataclass
+class Alert:
+	"""A detection rule changing state, `active` is False when it clears"""
+
+	kind: AlertKind
+	field: SensorField
+	value: float
+	limit: float
+	active: bool
+	timestamp: datetime
+
+	@property
+	def hazard(self) -> bool:
+		"""Whether the alert should trigger the alarm, anomalies only notify."""
+		return self.active and self.kind != "anomaly"
+
+	@property
+	def message(self) -> str:
+		name = "Temperature" if self.field == "temperature" else "Gas"
+		match self.kind:
+			case "threshold":
+				condition = f"{self.value:.1f} above limit {self.limit:.1f}"
+			case "rate_of_rise":
+				condition = f"rising {self.value:.1f}/min, limit {self.limit:.1f}/min"
+			case "anomaly":
+				condition = f"{self.value:.1f} sigma from recent readings"
+		return f"{name} {condition}" if self.active else f"{name} back to normal"
+
+
+class Ewma:
+	"""Exponentially weighted moving mean and variance"""
+
+	def __init__(self, alpha: float) -> None:
+		self.alpha = alpha
+		self.mean = 0.0
+		self.variance = 0.0
+		self.count = 0
+
+	def update(self, value: float) -> None:
+		if self.count == 0:
+			self.mean = value
+		else:
+			diff = value - self.mean
+			increment = self.alpha * diff
+			self.mean += increment
+			self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+		self.count += 1
+
+	def sigmas(self, value: float) -> float:
+		"""Distance of `value` from the mean in standard deviations."""
+		std = math.sqrt(self.variance)
+		if std == 0:
+			return 0.0
+		return abs(value - self.mean) / std
+
+
+class FieldDetector:
+	"""Rules over one sensor field, keeping O(1) state"""
+
+	def __init__(self, field: SensorField, threshold: float, rise: float) -> None:
+		self.field: SensorField = field
+		self.threshold = threshold
+		self.rise = rise
+		self.stats = Ewma(EWMA_ALPHA)
+		self.slope = Ewma(EWMA_ALPHA)
+		self.last: tuple[float, float] | None = None  # (seconds, smoothed value)
+		self.active: set[AlertKind] = set()
+
+	def observe(
+		self, seconds: float, value: float
+	) -> list[tuple[AlertKind, float, float, bool]]:
+		"""Feed one reading, returns the (kind, value, limit, active) transitions."""
+		# Scored against the statistics before this reading
+		sigmas = self.stats.sigmas(value)
+		warm = self.stats.count >= WARMUP_READINGS
+
+		self.stats.update(value)
+		if self.last is not None and seconds > self.last[0]:
+			per_minute = (
+				(self.stats.mean - self.last[1]) * 60 / (seconds - self.last[0])
+			)
+			self.slope.update(per_minute)
+		self.last = (seconds, self.stats.mean)
+
+		checks: list[tuple[AlertKind, float, float, bool]] = [
+			("threshold", value, self.threshold, value >= self.threshold),
+			(
+				"rate_of_rise",
+				self.slope.mean,
+				self.rise,
+				warm and self.slope.mean >= self.rise,
+			),
+			("anomaly", sigmas, ANOMALY_SIGMAS, warm and sigmas >= ANOMALY_SIGMAS),
+		]
+
+		transitions = []
+		for kind, measured, limit, firing in checks:
+			if firing != (kind in self.active):
+				if firing:
+					self.active.add(kind)
+				else:
+					self.active.discard(kind)
+				transitions.append((kind, measured, limit, firing))
+		return transitions
+
+
+class HazardDetector:
+	def __init__(self) -> None:
+		self.fields = [
+			FieldDetector("temperature", ALERT_TEMPERATURE, RISE_TEMPERATURE),
+			FieldDetector("gas", ALERT_GAS, RISE_GAS),
+		]
+
+	def load(self, window: SensorWindow) -> None:
+		"""Warm up on past readings without raising their alerts."""
+		for seconds, temperature, gas in zip(
+			window.timestamps.tolist(), window.temperature.tolist(), window.gas.tolist()
+		):
+			for detector, value in zip(self.fields, (temperature, gas)):
+				detector.observe(seconds, value)
+
+	def observe(
+		self, timestamp: datetime, temperature: float, gas: float
+	) -> list[Alert]:
+		"""Feed one reading, returns the alerts that were raised or cleared."""
+		seconds = to_timestamp(timestamp)
+		return [
+			Alert(kind, detector.field, measured, limit, active, timestamp)
+			for detector, value in zip(self.fields, (temperature, gas))
+			for kind, measured, limit, active in detector.observe(seconds, value)
+		]
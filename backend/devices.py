@@ -0,0 +1,121 @@
+"""
+Sensor boards and their MQTT topics. Boards publish readings on
+sensor/<device>/response and listen on sensor/<device>/request for polls and
+sensor/<device>/<relay|buzzer|led> for commands. The original single board
+keeps using the unprefixed topics under the id DEFAULT_DEVICE.
+"""
+
+from __future__ import annotations
+
+import math
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from os import environ as env
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from backend.detector import HazardDetector
+from backend.forecast import SensorForecaster
+from backend.models import DEFAULT_DEVICE, SensorRollupDay, from_millis, to_millis
+from backend.ring_buffer import SensorRingBuffer
+
+# Readings kept in memory for each device
+SENSOR_BUFFER_CAPACITY = int(env.get("SENSOR_BUFFER_CAPACITY", "86400"))
+
+# Recent readings replayed into the hazard detector at startup
+DETECTOR_WARMUP = 1000
+
+SENSOR_TOPICS = ["sensor/response", "sensor/+/response"]
+
+MAX_DEVICE_ID_LENGTH = 64
+
+# Device ids accepted from sensor topics, readings of any other are ignored
+DEVICE_ID_PATTERN = re.compile(env.get("DEVICE_ID_PATTERN", r"[A-Za-z0-9_.-]+"))
+
+# Devices tracked at most, each holds a ring buffer and is polled. Readings of
+# new devices past this are ignored.
+MAX_DEVICES = int(env.get("MAX_DEVICES", "32"))
+
+
+def valid_device_id(device_id: str) -> bool:
+	"""Whether `device_id` can be a device's id, and part of its topics."""
+	return len(device_id) <= MAX_DEVICE_ID_LENGTH and bool(
+		DEVICE_ID_PATTERN.fullmatch(device_id)
+	)
+
+
+def device_from_topic(topic: str) -> str | None:
+	"""The device a response topic belongs to, None if the id is invalid."""
+	parts = topic.split("/")
+	if len(parts) == 2:
+		return DEFAULT_DEVICE
+
+	device_id = parts[1]
+	return device_id if valid_device_id(device_id) else None
+
+
+def request_topic(device_id: str) -> str:
+	if device_id == DEFAULT_DEVICE:
+		return "sensor/request"
+	return f"sensor/{device_id}/request"
+
+
+def control_topic(device_id: str, name: str) -> str:
+	if device_id == DEFAULT_DEVICE:
+		return name
+	return f"sensor/{device_id}/{name}"
+
+
+def known_device_ids(db: Session) -> list[str]:
+	"""Every device with stored readings, from the small daily rollup table."""
+	device_ids = set(db.scalars(select(SensorRollupDay.device_id).distinct()))
+	device_ids.add(DEFAULT_DEVICE)
+	return sorted(device_ids)
+
+
+@dataclass
+class Device:
+	"""In-memory state kept for each sensor board"""
+
+	id: str
+	buffer: SensorRingBuffer
+	forecaster: SensorForecaster
+	detector: HazardDetector
+	# Id of the newest reading stamped, committed or not
+	last_stamp: int = 0
+
+	@classmethod
+	def create(cls, device_id: str) -> Device:
+		"""State for a device that has no readings stored yet."""
+		buffer = SensorRingBuffer(SENSOR_BUFFER_CAPACITY)
+		buffer.horizon = -math.inf
+		return cls(device_id, buffer, SensorForecaster(), HazardDetector())
+
+	@classmethod
+	def load(cls, db: Session, device_id: str) -> Device:
+		"""State for a known device, warmed up from its stored readings."""
+		device = cls(
+			device_id,
+			SensorRingBuffer(SENSOR_BUFFER_CAPACITY),
+			SensorForecaster(),
+			HazardDetector(),
+		)
+		device.buffer.load(db, device_id)
+
+		size = device.buffer.size
+		device.forecaster.load(device.buffer.slice(0, size))
+		device.detector.load(device.buffer.slice(max(size - DETECTOR_WARMUP, 0), size))
+		return device
+
+	def stamp(self, received: datetime) -> datetime:
+		"""
+		Timestamp of a reading received at `received`, truncated to milliseconds
+		and bumped past the device's previous one, as it is the reading's key.
+		"""
+		millis = max(
+			to_millis(received), self.last_stamp + 1, self.buffer.newest_id() + 1
+		)
+		self.last_stamp = millis
+		return from_millis(millis)
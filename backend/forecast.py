@@ -0,0 +1,165 @@
+"""
+Ridge regression forecast of the next sensor readings, predicting temperature
+and gas from the previous FORECAST_LOOKBACK values of both. The model is
+trained once from the sensor buffer at startup, then updated incrementally
+as readings are committed, so every client gets the same forecast for free.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from numpy.typing import NDArray
+
+from backend.ring_buffer import SensorWindow, from_timestamp, to_timestamp
+
+# Features: temperature[t..t-9] (10) + gas[t..t-9] (10) + bias (1)
+# Outputs: temperature[t+1], gas[t+1]
+FORECAST_LOOKBACK = 10
+FORECAST_STEPS = 5
+FORECAST_LAMBDA = 0.001
+NUM_FEATURES = 2 * FORECAST_LOOKBACK + 1
+NUM_OUTPUTS = 2
+
+
+class CholeskySolver:
+	"""
+	Ridge regression solved through the upper Cholesky factor U of
+	XᵀX + λI, kept current with a rank-1 update for every new sample.
+	"""
+
+	def __init__(self, x_cols: int, y_cols: int, lam: float) -> None:
+		self.U = np.sqrt(lam) * np.eye(x_cols)
+		self.Y = np.zeros((y_cols, x_cols))
+		self.samples = 0
+
+	def update(self, x: NDArray[np.float64], y: NDArray[np.float64]) -> None:
+		self.Y += np.outer(y, x)
+		self.samples += 1
+
+		U = self.U
+		w = x.copy()
+		b = 1.0
+		for i in range(len(w)):
+			li = U[i, i]
+			wi = w[i]
+			l2 = li * li
+			w2 = wi * wi
+			gamma = b * l2 + w2
+			l_ii = np.sqrt(l2 + w2 / b)
+
+			row = U[i, i + 1 :]
+			rest = w[i + 1 :]
+			rest -= (wi / li) * row
+			row *= l_ii / li
+			row += (l_ii * wi / gamma) * rest
+			U[i, i] = l_ii
+			b += w2 / l2
+
+	def fit(self, X: NDArray[np.float64], Y: NDArray[np.float64]) -> None:
+		"""Add many samples at once, cheaper than one update per row."""
+		self.U = np.linalg.cholesky(self.U.T @ self.U + X.T @ X).T
+		self.Y += Y.T @ X
+		self.samples += len(X)
+
+	def solve(self) -> NDArray[np.float64]:
+		"""Weights with one row per output."""
+		z = np.linalg.solve(self.U.T, self.Y.T)
+		return np.linalg.solve(self.U, z).T
+
+
+def sample_matrices(
+	temperature: NDArray[np.float64], gas: NDArray[np.float64]
+) -> tuple[NDArray[np.float64], NDArray[np.float64]]:
+	"""One training sample per reading that has FORECAST_LOOKBACK before it."""
+	count = len(temperature) - FORECAST_LOOKBACK
+	if count <= 0:
+		return np.empty((0, NUM_FEATURES)), np.empty((0, NUM_OUTPUTS))
+
+	# Newest value first, like the feature vectors used for prediction
+	temperature_lags = sliding_window_view(temperature, FORECAST_LOOKBACK)[:count, ::-1]
+	gas_lags = sliding_window_view(gas, FORECAST_LOOKBACK)[:count, ::-1]
+
+	X = np.hstack((temperature_lags, gas_lags, np.ones((count, 1))))
+	Y = np.column_stack((temperature[FORECAST_LOOKBACK:], gas[FORECAST_LOOKBACK:]))
+	return X, Y
+
+
+@dataclass
+class Forecast:
+	"""Predicted readings for the next FORECAST_STEPS sensor polls"""
+
+	timestamps: list[datetime]
+	temperature: list[float]
+	gas: list[float]
+
+
+class SensorForecaster:
+	def __init__(self) -> None:
+		self.solver = CholeskySolver(NUM_FEATURES, NUM_OUTPUTS, FORECAST_LAMBDA)
+		# (timestamp, temperature, gas) of the newest readings
+		self.recent: deque[tuple[float, float, float]] = deque(maxlen=FORECAST_LOOKBACK)
+		self.latest: Forecast | None = None
+
+	def load(self, window: SensorWindow) -> None:
+		"""Train on a run of readings, oldest first."""
+		self.train(window.timestamps, window.temperature, window.gas)
+
+	def update(self, rows: list[tuple[int, datetime, float, float]]) -> None:
+		"""Train on freshly committed readings and refresh the forecast."""
+		if not rows:
+			return
+
+		self.train(
+			np.fromiter((to_timestamp(row[1]) for row in rows), np.float64, len(rows)),
+			np.fromiter((row[2] for row in rows), np.float64, len(rows)),
+			np.fromiter((row[3] for row in rows), np.float64, len(rows)),
+		)
+
+	def train(
+		self,
+		timestamps: NDArray[np.float64],
+		temperature: NDArray[np.float64],
+		gas: NDArray[np.float64],
+	) -> None:
+		# Samples may start in the readings kept from previous batches
+		X, Y = sample_matrices(
+			np.concatenate(([row[1] for row in self.recent], temperature)),
+			np.concatenate(([row[2] for row in self.recent], gas)),
+		)
+
+		if len(X) > NUM_FEATURES:
+			self.solver.fit(X, Y)
+		else:
+			for x, y in zip(X, Y):
+				self.solver.update(x, y)
+
+		self.recent.extend(zip(timestamps.tolist(), temperature.tolist(), gas.tolist()))
+		self.latest = self.predict()
+
+	def predict(self) -> Forecast | None:
+		"""Roll the model forward FORECAST_STEPS times from the newest readings."""
+		if self.solver.samples == 0 or len(self.recent) < FORECAST_LOOKBACK:
+			return None
+
+		weights = self.solver.solve()
+		timestamps, temperature, gas = (list(column) for column in zip(*self.recent))
+		interval = (timestamps[-1] - timestamps[0]) / (len(timestamps) - 1)
+
+		forecast = Forecast(timestamps=[], temperature=[], gas=[])
+		for step in range(1, FORECAST_STEPS + 1):
+			x = np.array([*temperature[::-1], *gas[::-1], 1.0])
+			next_temperature, next_gas = (weights @ x).tolist()
+
+			forecast.timestamps.append(from_timestamp(timestamps[-1] + interval * step))
+			forecast.temperature.append(next_temperature)
+			forecast.gas.append(next_gas)
+
+			temperature = [*temperature[1:], next_temperature]
+			gas = [*gas[1:], next_gas]
+
+		return forecast
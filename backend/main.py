@@ -7,15 +7,18 @@ from typing import Callable
 import aiofiles
 import uvicorn
 from starlette.applications import Starlette
+from starlette.middleware import Middleware
 from starlette.requests import Request
 from starlette.responses import HTMLResponse, Response
 from starlette.routing import Mount, Route
 from starlette.staticfiles import StaticFiles
 
+from backend.broker import WORKERS
 from backend.modules.auth import auth_controller
 from backend.modules.chat import chat_controller
 from backend.modules.dashboard import dashboard_controller
 from backend.modules.websocket import websocket_controller
+from backend.request_db import RequestDbMiddleware
 from backend.state import AppState
 
 
@@ -81,11 +84,14 @@ app = Starlette(
 		Mount("/dashboard", routes=dashboard_controller.routes),
 		*websocket_controller.routes,
 	],
+	middleware=[Middleware(RequestDbMiddleware)],
 	lifespan=lifespan,
 )
 
 if __name__ == "__main__":
 	if dev:
 		uvicorn.run("backend.main:app", host="127.0.0.1", port=port, reload=True)
+	elif WORKERS > 1:
+		uvicorn.run("backend.main:app", host=host, port=port, workers=WORKERS)
 	else:
 		uvicorn.run(app, host=host, port=port)
@@ -0,0 +1,202 @@
+"""
+Bring the schema of an existing database up to date. Every step inspects the
+live schema first, so this is safe to run on every startup. Migrations hold
+MIGRATE_LOCK, so the workers of a host never run them concurrently.
+
+The app migrates its local database at startup. A remote (Turso) database is
+shared by every host and slow to convert over the network, so it has to be
+migrated offline with this command before the app starts.
+
+Usage: python -m backend.migrate
+"""
+
+import fcntl
+from collections.abc import Generator
+from contextlib import contextmanager
+from datetime import datetime
+from os import environ as env
+
+from sqlalchemy import Connection, Engine, insert, inspect
+from sqlalchemy.orm import Session
+
+from backend.models import (
+	DEFAULT_DEVICE,
+	Base,
+	SensorData,
+	SpoolCursor,
+	from_millis,
+	to_millis,
+)
+from backend.rollups import ROLLUPS, backfill_rollups
+from backend.storage import is_local
+
+MIGRATE_LOCK = env.get("MIGRATE_LOCK", "migrate.lock")
+
+# Rows copied per statement when converting sensor_data to the compact layout
+CONVERT_CHUNK_SIZE = 10000
+
+
+@contextmanager
+def migration_lock(path: str = MIGRATE_LOCK) -> Generator[None]:
+	"""Wait for other processes migrating on this host, and hold them off."""
+	with open(path, "a") as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+		yield
+
+
+def convert_sensor_data(conn: Connection, forwarded_id: int | None) -> dict[str, int]:
+	"""
+	Copy the rowid table renamed to sensor_data_legacy into the compact
+	sensor_data, walking its (device_id, timestamp) index. Timestamps shared
+	by several readings of a device at millisecond precision are bumped apart
+	like Device.stamp does. Returns the new id of the newest legacy row up to
+	`forwarded_id` of each device, to carry the spool's cursor over.
+	"""
+	forwarded: dict[str, int] = {}
+	previous_device, previous_millis = None, 0
+	converted = 0
+
+	after = None
+	while True:
+		query = (
+			"SELECT id, device_id, timestamp, temperature, gas FROM sensor_data_legacy "
+		)
+		if after is not None:
+			query += "WHERE (device_id, timestamp, id) > (?, ?, ?) "
+		query += f"ORDER BY device_id, timestamp, id LIMIT {CONVERT_CHUNK_SIZE}"
+		rows = conn.exec_driver_sql(query, after or ()).all()
+		if not rows:
+			break
+
+		chunk = []
+		for id, device_id, timestamp, temperature, gas in rows:
+			# Legacy rows hold the server's local time
+			millis = to_millis(datetime.fromisoformat(timestamp).astimezone())
+			if device_id == previous_device:
+				millis = max(millis, previous_millis + 1)
+			previous_device, previous_millis = device_id, millis
+
+			if forwarded_id is not None and id <= forwarded_id:
+				forwarded[device_id] = max(forwarded.get(device_id, 0), millis)
+
+			chunk.append(
+				{
+					"device_id": device_id,
+					"timestamp": from_millis(millis),
+					"temperature": temperature,
+					"gas": gas,
+				}
+			)
+
+		conn.execute(insert(SensorData), chunk)
+		converted += len(chunk)
+		after = tuple(rows[-1][1:3]) + (rows[-1][0],)
+
+	print(f"Converted {converted} sensor readings")
+	return forwarded
+
+
+def is_current(engine: Engine) -> bool:
+	"""Whether migrate has nothing left to do on `engine`."""
+	inspector = inspect(engine)
+	if not set(Base.metadata.tables) <= set(inspector.get_table_names()):
+		return False
+
+	def columns(table: str) -> set[str]:
+		return {c["name"] for c in inspector.get_columns(table)}
+
+	sensor_columns = columns("sensor_data")
+	return (
+		"device_id" in sensor_columns
+		and "id" not in sensor_columns
+		and all("device_id" in columns(model.__tablename__) for model in ROLLUPS)
+	)
+
+
+def migrate(engine: Engine) -> None:
+	with engine.begin() as conn:
+		inspector = inspect(conn)
+		tables = set(inspector.get_table_names())
+
+		def has_column(table: str, column: str) -> bool:
+			return any(c["name"] == column for c in inspector.get_columns(table))
+
+		if "sensor_data" in tables and not has_column("sensor_data", "device_id"):
+			print("Adding device_id to sensor_data")
+			conn.exec_driver_sql(
+				"ALTER TABLE sensor_data ADD COLUMN device_id VARCHAR(64) "
+				f"NOT NULL DEFAULT '{DEFAULT_DEVICE}'"
+			)
+
+		# Rowid table with a DATETIME column, from before the compact layout
+		legacy = "sensor_data" in tables and has_column("sensor_data", "id")
+		if legacy:
+			print("Converting sensor_data to the compact layout")
+			forwarded_id = None
+			if "spool_cursor" in tables:
+				forwarded_id = (
+					conn.exec_driver_sql(
+						"SELECT max(forwarded_id) FROM spool_cursor"
+					).scalar()
+					or 0
+				)
+				conn.exec_driver_sql("DROP TABLE spool_cursor")
+
+			conn.exec_driver_sql("ALTER TABLE sensor_data RENAME TO sensor_data_legacy")
+			SensorData.__table__.create(conn)
+			forwarded = convert_sensor_data(conn, forwarded_id)
+			conn.exec_driver_sql("DROP TABLE sensor_data_legacy")
+
+			if forwarded_id is not None:
+				SpoolCursor.__table__.create(conn)
+				if forwarded:
+					conn.execute(
+						insert(SpoolCursor),
+						[
+							{"device_id": device_id, "forwarded_id": forwarded_id}
+							for device_id, forwarded_id in forwarded.items()
+						],
+					)
+
+		# Rollups only hold derived data, rebuild them rather than migrate rows.
+		# Their last_id refers to the legacy ids too.
+		stale_rollups = [
+			model
+			for model in ROLLUPS
+			if model.__tablename__ in tables
+			and (legacy or not has_column(model.__tablename__, "device_id"))
+		]
+		for model in stale_rollups:
+			print(f"Rebuilding {model.__tablename__}")
+			model.__table__.drop(conn)
+
+		# Rollup tables created below start out empty, existing readings have
+		# to be folded into them
+		rebuild_rollups = "sensor_data" in tables and any(
+			model.__tablename__ not in tables or model in stale_rollups
+			for model in ROLLUPS
+		)
+
+	Base.metadata.create_all(bind=engine)
+
+	if rebuild_rollups:
+		with Session(engine) as db, db.begin():
+			backfill_rollups(db)
+
+	if legacy and is_local(engine):
+		# Return the legacy table's pages to the filesystem
+		with engine.connect() as conn:
+			conn.exec_driver_sql("VACUUM")
+
+
+def main() -> None:
+	from backend.storage import create_db_engine
+
+	engine = create_db_engine()
+	with migration_lock():
+		migrate(engine)
+	engine.dispose()
+
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,19 @@
-from sqlalchemy import Boolean, Column, DateTime, Float, Integer, String
-from sqlalchemy.orm import DeclarativeBase
+from datetime import datetime, timedelta, timezone
+from typing import ClassVar
+
+from sqlalchemy import (
+	BigInteger,
+	Boolean,
+	Column,
+	DateTime,
+	Dialect,
+	Float,
+	Integer,
+	String,
+	TypeDecorator,
+	type_coerce,
+)
+from sqlalchemy.orm import DeclarativeBase, column_property
 from sqlalchemy.sql import func
 
 
@@ -11,6 +25,8 @@ class User(Base):
 	"""User model for authentication"""
 
 	__tablename__ = "users"
+	# Fetch created_at with the INSERT's RETURNING, not a second SELECT
+	__mapper_args__: ClassVar[dict[str, object]] = {"eager_defaults": True}
 
 	id = Column(Integer, primary_key=True, index=True)
 	email = Column(String(100), unique=True, index=True, nullable=False)
@@ -19,14 +35,115 @@ class User(Base):
 	is_active = Column(Boolean, default=True)
 
 
+# Readings from boards that don't report an id, i.e. the legacy topics
+DEFAULT_DEVICE = "default"
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_millis(timestamp: datetime) -> int:
+	# Naive timestamps are UTC by convention, like SQLite's strftime('%s')
+	if timestamp.tzinfo is not None:
+		timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+	return (timestamp - EPOCH) // timedelta(milliseconds=1)
+
+
+def utc_now() -> datetime:
+	"""The current time as a naive UTC datetime, like every stored timestamp."""
+	return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_iso(timestamp: datetime) -> str:
+	# With the offset spelled out, clients read a bare ISO 8601 time as local
+	return timestamp.isoformat() + "Z"
+
+
+def from_millis(millis: int) -> datetime:
+	# Positional arguments are about twice as fast, this runs for every row read
+	return EPOCH + timedelta(0, 0, 0, millis)
+
+
+class EpochMillis(TypeDecorator[datetime]):
+	"""Naive UTC datetime stored as integer epoch milliseconds"""
+
+	impl = BigInteger
+	cache_ok = True
+
+	def process_bind_param(
+		self, value: datetime | None, dialect: Dialect
+	) -> int | None:
+		return None if value is None else to_millis(value)
+
+	def process_result_value(
+		self, value: int | None, dialect: Dialect
+	) -> datetime | None:
+		return None if value is None else from_millis(value)
+
+
 class SensorData(Base):
-	"""Sensor data model for storing temperature and gas readings"""
+	"""
+	Sensor readings, clustered by device and time: the table is the primary
+	key's B-tree, so per-device history queries are a single range scan.
+	"""
 
 	__tablename__ = "sensor_data"
+	__table_args__: ClassVar[dict[str, object]] = {"sqlite_with_rowid": False}
 
-	id = Column(Integer, primary_key=True, index=True)
-	timestamp = Column(
-		DateTime(timezone=True), server_default=func.now(), nullable=False, index=True
-	)
+	device_id = Column(String(64), primary_key=True)
+	# Kept increasing per device at ingest, so it identifies the reading
+	timestamp = Column(EpochMillis, primary_key=True)
 	temperature = Column(Float, nullable=False)
 	gas = Column(Float, nullable=False)
+
+	# A reading's id is its timestamp in epoch milliseconds, a cursor within
+	# the device's readings
+	id = column_property(type_coerce(timestamp, BigInteger))
+
+
+class SensorRollup(Base):
+	"""
+	Pre-aggregated sensor readings per device and time bucket, maintained at
+	ingest time. `bucket` is the bucket start in epoch seconds.
+	"""
+
+	__abstract__ = True
+
+	resolution: ClassVar[int]
+
+	device_id = Column(String(64), primary_key=True)
+	bucket = Column(Integer, primary_key=True)
+	count = Column(Integer, nullable=False)
+	last_id = Column(Integer, nullable=False)
+	temperature_sum = Column(Float, nullable=False)
+	temperature_min = Column(Float, nullable=False)
+	temperature_max = Column(Float, nullable=False)
+	gas_sum = Column(Float, nullable=False)
+	gas_min = Column(Float, nullable=False)
+	gas_max = Column(Float, nullable=False)
+
+
+class SensorRollupMinute(SensorRollup):
+	__tablename__ = "sensor_rollup_minute"
+	resolution = 60
+
+
+class SensorRollupHour(SensorRollup):
+	__tablename__ = "sensor_rollup_hour"
+	resolution = 3600
+
+
+class SensorRollupDay(SensorRollup):
+	__tablename__ = "sensor_rollup_day"
+	resolution = 86400
+
+
+class SpoolCursor(Base):
+	"""
+	Newest sensor_data id of each device in the local spool that is already
+	committed to the remote database.
+	"""
+
+	__tablename__ = "spool_cursor"
+
+	device_id = Column(String(64), primary_key=True)
+	forwarded_id = Column(BigInteger, nullable=False)
@@ -4,11 +4,18 @@ from starlette.requests import Request
 from starlette.responses import Response
 from starlette.routing import BaseRoute, Route
 
-from backend.models import User
 from backend.state import AppState
 
 from .auth_models import UserCreate, UserLogin
-from .auth_service import authenticate, hash_create, hash_verify, logout
+from .auth_service import (
+	HashPoolBusy,
+	authenticate,
+	create_user,
+	find_user,
+	hash_create,
+	hash_verify,
+	logout,
+)
 
 
 def strip_prefix(text: str, prefix: str) -> str:
@@ -20,55 +27,55 @@ def strip_prefix(text: str, prefix: str) -> str:
 
 async def handle_register(request: Request) -> Response:
 	state = AppState.get(request)
-	with state.get_db() as db:
-		try:
-			payload = await request.json()
-			user_create = UserCreate(**payload)
-			password_hash = hash_create(user_create.password)
-			user_db = User(
-				email=user_create.email,
-				password_hash=password_hash,
-			)
-
-			db.add(user_db)
-			db.commit()
-			db.refresh(user_db)
-
-			return authenticate(user_db)
-		except ValidationError as e:
-			# Extract first error message from pydantic validation error
-			first_error = e.errors()[0]
-			error_msg = first_error.get("msg", str(e))
-			error_msg = strip_prefix(error_msg, "Value error, ")
-			return Response(error_msg, status_code=400)
-		except IntegrityError:
-			db.rollback()
-			return Response("Username or email already registered", status_code=400)
+	try:
+		payload = await request.json()
+		user_create = UserCreate(**payload)
+		password_hash = await hash_create(user_create.password)
+	except ValidationError as e:
+		# Extract first error message from pydantic validation error
+		first_error = e.errors()[0]
+		error_msg = first_error.get("msg", str(e))
+		error_msg = strip_prefix(error_msg, "Value error, ")
+		return Response(error_msg, status_code=400)
+	except HashPoolBusy:
+		return Response("Server busy, please try again", status_code=503)
+
+	try:
+		user_db = await state.run_write(
+			lambda db: create_user(db, user_create.email, password_hash)
+		)
+	except IntegrityError:
+		return Response("Username or email already registered", status_code=400)
+
+	return authenticate(user_db)
 
 
 async def handle_login(request: Request) -> Response:
 	state = AppState.get(request)
-	with state.get_db() as db:
-		try:
-			payload = await request.json()
-			user_login = UserLogin(**payload)
-
-			user = db.query(User).filter((User.email == user_login.email)).first()
-
-			if user is None:
-				return Response("Wrong username or password", status_code=401)
-
-			if not hash_verify(user_login.password, str(user.password_hash)):
-				return Response("Wrong username or password", status_code=401)
-
-			return authenticate(user)
-
-		except ValidationError as e:
-			# Extract first error message from pydantic validation error
-			first_error = e.errors()[0]
-			error_msg = first_error.get("msg", str(e))
-			error_msg = strip_prefix(error_msg, "Value error, ")
-			return Response(error_msg, status_code=400)
+	try:
+		payload = await request.json()
+		user_login = UserLogin(**payload)
+
+		user = await state.run_db(lambda db: find_user(db, user_login.email))
+		# Release the session before hashing, verification can queue for a while
+		await state.release_db()
+
+		if user is None:
+			return Response("Wrong username or password", status_code=401)
+
+		if not await hash_verify(user_login.password, str(user.password_hash)):
+			return Response("Wrong username or password", status_code=401)
+
+		return authenticate(user)
+
+	except ValidationError as e:
+		# Extract first error message from pydantic validation error
+		first_error = e.errors()[0]
+		error_msg = first_error.get("msg", str(e))
+		error_msg = strip_prefix(error_msg, "Value error, ")
+		return Response(error_msg, status_code=400)
+	except HashPoolBusy:
+		return Response("Server busy, please try again", status_code=503)
 
 
 async def handle_logout(_: Request) -> Response:
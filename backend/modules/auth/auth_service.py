@@ -1,8 +1,18 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from os import environ as env
+from threading import Lock
+from time import monotonic
+from typing import TypeVar
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
 from starlette.requests import HTTPConnection
 from starlette.responses import JSONResponse, Response
 
@@ -11,16 +21,94 @@ from backend.state import AppState
 
 secret_key = env.get("JWT_SECRET_KEY", default="secret-key")
 token_expire_min = int(env.get("JWT_EXPIRE_MIN", default="30"))
+user_cache_size = int(env.get("USER_CACHE_SIZE", default="1024"))
+user_cache_ttl = float(env.get("USER_CACHE_TTL", default="60"))
+hash_workers = int(env.get("HASH_WORKERS", default="2"))
+hash_queue_limit = int(env.get("HASH_QUEUE_LIMIT", default="32"))
+# Waits for a hashing worker longer than this many seconds are logged
+hash_slow_wait = float(env.get("HASH_SLOW_WAIT", default="0.5"))
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
+T = TypeVar("T")
 
-def hash_create(password: str) -> str:
-	return pwd_context.hash(password)
 
+class HashPoolBusy(Exception):
+	"""Raised when too many password hashes are already waiting for a worker"""
 
-def hash_verify(password: str, hash: str) -> bool:
-	return pwd_context.verify(password, hash)
+
+@dataclass
+class HashPoolStats:
+	in_flight: int = 0
+	waiting: int = 0
+	completed: int = 0
+	rejected: int = 0
+	total_wait: float = 0.0
+	max_wait: float = 0.0
+
+	def report(self) -> str:
+		started = max(self.completed + self.in_flight, 1)
+		return (
+			f"{self.in_flight} in flight, {self.waiting} waiting, "
+			f"{self.completed} completed, {self.rejected} rejected, "
+			f"wait avg {self.total_wait / started * 1000:.0f}ms "
+			f"max {self.max_wait * 1000:.0f}ms"
+		)
+
+
+class HashPool:
+	"""
+	Runs Argon2 hashing on a small thread pool (argon2-cffi releases the GIL)
+	so it doesn't stall the event loop. At most `workers` hashes run at once,
+	and at most `queue_limit` wait for a slot before new ones are rejected.
+	"""
+
+	def __init__(self, workers: int, queue_limit: int) -> None:
+		self.executor = ThreadPoolExecutor(workers, thread_name_prefix="argon2")
+		self.slots = asyncio.Semaphore(workers)
+		self.queue_limit = queue_limit
+		self.stats = HashPoolStats()
+
+	async def run(self, fn: Callable[..., T], *args: object) -> T:
+		if self.stats.waiting >= self.queue_limit:
+			self.stats.rejected += 1
+			if self.stats.rejected % 100 == 1:
+				print(f"Password hashing saturated: {self.stats.report()}")
+			raise HashPoolBusy()
+
+		self.stats.waiting += 1
+		queued = monotonic()
+		try:
+			await self.slots.acquire()
+		finally:
+			self.stats.waiting -= 1
+
+		wait = monotonic() - queued
+		self.stats.total_wait += wait
+		longest = wait > self.stats.max_wait
+		self.stats.max_wait = max(self.stats.max_wait, wait)
+
+		self.stats.in_flight += 1
+		if longest and wait > hash_slow_wait:
+			print(f"Password hashing queue is backing up: {self.stats.report()}")
+		try:
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(self.executor, fn, *args)
+		finally:
+			self.stats.in_flight -= 1
+			self.stats.completed += 1
+			self.slots.release()
+
+
+hash_pool = HashPool(hash_workers, hash_queue_limit)
+
+
+async def hash_create(password: str) -> str:
+	return await hash_pool.run(pwd_context.hash, password)
+
+
+async def hash_verify(password: str, hash: str) -> bool:
+	return await hash_pool.run(pwd_context.verify, password, hash)
 
 
 def create_access_token(data: dict, expires_delta: timedelta):
@@ -68,22 +156,90 @@ def authenticate(user: User) -> Response:
 	return response
 
 
-def get_user(request: HTTPConnection) -> User | None:
-	state = AppState.get(request)
-	with state.get_db() as db:
-		token = request.cookies.get("access_token")
+class UserCache:
+	"""
+	LRU cache of active users keyed by email (the token subject). Entries
+	expire after `ttl` seconds so changes made outside this process are picked
+	up eventually, changes made through the ORM invalidate them immediately.
+	"""
 
-		if token is None:
-			return None
+	def __init__(self, size: int, ttl: float) -> None:
+		self.size = size
+		self.ttl = ttl
+		self.entries: OrderedDict[str, tuple[float, User]] = OrderedDict()
+		self.lock = Lock()
 
-		username = verify_token(token)
-		if username is None:
-			return None
-		user = db.query(User).filter(User.email == username).first()
+	def get(self, email: str) -> User | None:
+		with self.lock:
+			entry = self.entries.get(email)
+			if entry is None:
+				return None
+
+			expires, user = entry
+			if expires < monotonic():
+				del self.entries[email]
+				return None
 
-		if user is not None and bool(user.is_active):
+			self.entries.move_to_end(email)
 			return user
 
+	def put(self, email: str, user: User) -> None:
+		with self.lock:
+			self.entries[email] = (monotonic() + self.ttl, user)
+			self.entries.move_to_end(email)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+	def invalidate(self, email: str) -> None:
+		with self.lock:
+			self.entries.pop(email, None)
+
+
+user_cache = UserCache(user_cache_size, user_cache_ttl)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_user(mapper, connection, target: User) -> None:
+	user_cache.invalidate(str(target.email))
+
+	# Also drop the entry under the previous email if it was changed
+	for email in inspect(target).attrs.email.history.deleted:
+		user_cache.invalidate(email)
+
+
+def find_user(db: Session, email: str) -> User | None:
+	return db.query(User).filter(User.email == email).first()
+
+
+def create_user(db: Session, email: str, password_hash: str) -> User:
+	user = User(email=email, password_hash=password_hash)
+	db.add(user)
+	# Flush to catch a taken email before the id is read
+	db.flush()
+	return user
+
+
+async def get_user(request: HTTPConnection) -> User | None:
+	token = request.cookies.get("access_token")
+	if token is None:
+		return None
+
+	username = verify_token(token)
+	if username is None:
+		return None
+
+	user = user_cache.get(username)
+	if user is not None:
+		return user
+
+	state = AppState.get(request)
+	user = await state.run_db(lambda db: find_user(db, username))
+
+	if user is not None and bool(user.is_active):
+		user_cache.put(username, user)
+		return user
+
 	return None
 
 
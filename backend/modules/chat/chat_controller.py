@@ -1,11 +1,17 @@
-from pydantic import ValidationError
+from collections.abc import AsyncIterator
+
+from pydantic import BaseModel, ValidationError
 from starlette.requests import Request
-from starlette.responses import JSONResponse, Response
+from starlette.responses import Response, StreamingResponse
 from starlette.routing import BaseRoute, Route
 
 from backend.modules.auth.auth_service import get_user
-from backend.modules.chat.chat_models import ChatRequest, ChatResponse
-from backend.modules.chat.chat_service import chat
+from backend.modules.chat.chat_models import (
+	ChatRequest,
+	TextDelta,
+	ToolCall,
+)
+from backend.modules.chat.chat_service import ChatEvent, chat
 from backend.state import AppState
 
 
@@ -16,31 +22,57 @@ def strip_prefix(text: str, prefix: str) -> str:
 	return text
 
 
+def sse(event: str, data: BaseModel | None = None) -> str:
+	"""Encode a server-sent event."""
+	payload = "{}" if data is None else data.model_dump_json()
+	return f"event: {event}\ndata: {payload}\n\n"
+
+
+def event_name(event: ChatEvent) -> str:
+	if isinstance(event, TextDelta):
+		return "delta"
+	if isinstance(event, ToolCall):
+		return "tool_call"
+	return "message"
+
+
+async def stream_chat(
+	state: AppState, messages: list[dict[str, str]]
+) -> AsyncIterator[str]:
+	try:
+		async for event in chat(state, messages):
+			yield sse(event_name(event), event)
+	except Exception as e:
+		print(f"Chat error: {e}")
+		yield sse("error")
+		return
+
+	yield sse("done")
+
+
 async def handle_chat(request: Request) -> Response:
-	user = get_user(request)
+	user = await get_user(request)
 	if user is None:
 		return Response(status_code=401)
 
 	try:
 		payload = await request.json()
 		chat_request = ChatRequest(**payload)
-
-		state = AppState.get(request)
-		messages_dict = [msg.model_dump() for msg in chat_request.messages]
-		result = chat(state, messages_dict)
-
-		response = ChatResponse(
-			messages=result.messages,
-			tool_calls=result.tool_calls,
-		)
-		return JSONResponse(response.model_dump())
-
 	except ValidationError as e:
 		first_error = e.errors()[0]
 		error_msg = first_error.get("msg", str(e))
 		error_msg = strip_prefix(error_msg, "Value error, ")
 		return Response(error_msg, status_code=400)
 
+	state = AppState.get(request)
+	messages_dict = [msg.model_dump() for msg in chat_request.messages]
+
+	return StreamingResponse(
+		stream_chat(state, messages_dict),
+		media_type="text/event-stream",
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+	)
+
 
 routes: list[BaseRoute] = [
 	Route("/", handle_chat, methods=["POST"]),
@@ -38,8 +38,7 @@ class ChatRequest(BaseModel):
 		return v
 
 
-class ChatResponse(BaseModel):
-	"""Chat response payload."""
+class TextDelta(BaseModel):
+	"""A chunk of assistant text streamed as it is generated."""
 
-	messages: list[ChatMessage]
-	tool_calls: list[ToolCall]
+	text: str
@@ -1,21 +1,32 @@
 from __future__ import annotations
 
+import asyncio
 import json
-from collections.abc import Callable
+from collections.abc import AsyncIterator, Awaitable, Callable
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import timedelta
 from os import environ as env
 from typing import Final
 
-from openai.types.responses import ResponseInputParam, ToolParam
+from aiomqtt import MqttError
+from openai.types.responses import (
+	ResponseFunctionToolCall,
+	ResponseInputParam,
+	ToolParam,
+)
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
-from backend.models import SensorData
+from backend.devices import valid_device_id
+from backend.models import DEFAULT_DEVICE, SensorData, utc_now
+from backend.modules.chat.chat_models import ChatMessage, TextDelta, ToolCall
 from backend.modules.dashboard.devices_control.devices_service import (
 	set_buzzer,
 	set_relay,
 )
-from backend.state import AppState, start_task
-from backend.tasks.poll_sensors import poll_sensors
+from backend.ring_buffer import SensorWindow, from_timestamp
+from backend.rollups import SensorBucket, query_buckets
+from backend.state import AppState
 
 MODEL = env.get("MODEL", "gpt-4o-mini")
 
@@ -25,10 +36,16 @@ Keep response concise, refrain from answering outside of your domain.
 
 You have access to the system's sensors, which is polled periodically every few
 seconds. When presenting sensor data, format it as a markdown table for clarity.
+Each sensor board is identified by a device id, the original board is "default".
 """
 
+
+class ChatError(Exception):
+	"""Raised when the model reports an error while streaming a response"""
+
+
 # Type alias for tool handler functions
-ToolHandler = Callable[[AppState, dict[str, object]], str]
+ToolHandler = Callable[[AppState, dict[str, object]], Awaitable[str]]
 
 
 @dataclass
@@ -39,47 +56,95 @@ class Tool:
 	handler: ToolHandler
 
 
+DEVICE_PARAM: Final = {
+	"type": ["string", "null"],
+	"description": "Optional id of the sensor board, fallback to the default board.",
+}
+
+
+def device_argument(arguments: dict[str, object]) -> str:
+	device = arguments.get("device")
+	return device if isinstance(device, str) and device else DEFAULT_DEVICE
+
+
 def get_sensor_data_by_time(
-	state: AppState, time_delta_seconds: float | None = None, limit: int | None = None
-) -> list[SensorData]:
+	db: Session,
+	device_id: str,
+	time_delta_seconds: float | None = None,
+	limit: int | None = None,
+) -> SensorWindow:
 	"""Retrieve sensor data by time delta or limit."""
-	with state.get_db() as db:
-		query = db.query(SensorData).order_by(SensorData.timestamp.desc())
-
+	query = (
+		select(SensorData.id, SensorData.temperature, SensorData.gas)
+		.where(SensorData.device_id == device_id)
+		.order_by(SensorData.timestamp.desc())
+	)
+
+	if time_delta_seconds is not None:
+		cutoff = utc_now() - timedelta(seconds=time_delta_seconds)
+		query = query.where(SensorData.timestamp >= cutoff)
+	elif limit is not None:
+		query = query.limit(limit)
+
+	rows = db.execute(query).all()
+	return SensorWindow.from_ids(rows[::-1])
+
+
+async def get_recent_sensor_data(
+	state: AppState,
+	device_id: str,
+	time_delta_seconds: float | None = None,
+	limit: int | None = None,
+) -> SensorWindow:
+	"""
+	Retrieve sensor data by time delta or limit, from the device's in-memory
+	buffer when it covers the window and from the database otherwise.
+	"""
+	data = None
+	device = state.devices.get(device_id)
+	if device is not None:
 		if time_delta_seconds is not None:
-			cutoff = datetime.now() - timedelta(seconds=time_delta_seconds)
-			query = query.filter(SensorData.timestamp >= cutoff)
-		elif limit is not None:
-			query = query.limit(limit)
+			cutoff = utc_now() - timedelta(seconds=time_delta_seconds)
+			data = device.buffer.since(cutoff)
 		else:
 			# Default limit if neither specified
-			query = query.limit(10)
+			data = device.buffer.latest(limit if limit is not None else 10)
 
-		return query.all()
+	if data is not None:
+		return data
 
+	return await state.run_db(
+		lambda db: get_sensor_data_by_time(
+			db, device_id, time_delta_seconds, limit or 10
+		)
+	)
 
-def format_temperature_table(data: list[SensorData]) -> str:
-	"""Format temperature data as a markdown table."""
-	if not data:
+
+def format_temperature_table(data: SensorWindow) -> str:
+	"""Format temperature data as a markdown table, newest first."""
+	if not len(data):
 		return "No temperature data available."
 
-	rows = ["| Timestamp | Temperature (°C) |", "|-----------|------------------|"]
-	for reading in data:
-		timestamp = reading.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-		rows.append(f"| {timestamp} | {reading.temperature:.2f} |")
+	rows = [
+		"| Timestamp (UTC) | Temperature (°C) |",
+		"|-----------------|------------------|",
+	]
+	for seconds, temperature in zip(data.timestamps[::-1], data.temperature[::-1]):
+		timestamp = from_timestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+		rows.append(f"| {timestamp} | {temperature:.2f} |")
 
 	return "\n".join(rows)
 
 
-def format_gas_table(data: list[SensorData]) -> str:
-	"""Format gas data as a markdown table."""
-	if not data:
+def format_gas_table(data: SensorWindow) -> str:
+	"""Format gas data as a markdown table, newest first."""
+	if not len(data):
 		return "No gas data available."
 
-	rows = ["| Timestamp | Gas Level |", "|-----------|-----------|"]
-	for reading in data:
-		timestamp = reading.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-		rows.append(f"| {timestamp} | {reading.gas:.2f} |")
+	rows = ["| Timestamp (UTC) | Gas Level |", "|-----------------|-----------|"]
+	for seconds, gas in zip(data.timestamps[::-1], data.gas[::-1]):
+		timestamp = from_timestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+		rows.append(f"| {timestamp} | {gas:.2f} |")
 
 	return "\n".join(rows)
 
@@ -102,13 +167,14 @@ SENSOR_PARAMS: Final = {
 				conflict.
 			""",
 		},
+		"device": DEVICE_PARAM,
 	},
-	"required": ["timeDelta", "limit"],
+	"required": ["timeDelta", "limit", "device"],
 	"additionalProperties": False,
 }
 
 
-def handle_get_temperature(state: AppState, arguments: dict[str, object]) -> str:
+async def handle_get_temperature(state: AppState, arguments: dict[str, object]) -> str:
 	"""Handle get_temperature tool call."""
 	time_delta = arguments.get("timeDelta")
 	limit_val = arguments.get("limit")
@@ -123,11 +189,13 @@ def handle_get_temperature(state: AppState, arguments: dict[str, object]) -> str
 	if isinstance(limit_val, (int, float)):
 		limit = int(limit_val)
 
-	data = get_sensor_data_by_time(state, time_delta_float, limit)
+	data = await get_recent_sensor_data(
+		state, device_argument(arguments), time_delta_float, limit
+	)
 	return format_temperature_table(data)
 
 
-def handle_get_gas(state: AppState, arguments: dict[str, object]) -> str:
+async def handle_get_gas(state: AppState, arguments: dict[str, object]) -> str:
 	"""Handle get_gas tool call."""
 	time_delta = arguments.get("timeDelta")
 	limit_val = arguments.get("limit")
@@ -142,10 +210,112 @@ def handle_get_gas(state: AppState, arguments: dict[str, object]) -> str:
 	if isinstance(limit_val, (int, float)):
 		limit = int(limit_val)
 
-	data = get_sensor_data_by_time(state, time_delta_float, limit)
+	data = await get_recent_sensor_data(
+		state, device_argument(arguments), time_delta_float, limit
+	)
 	return format_gas_table(data)
 
 
+SUMMARY_PARAMS: Final = {
+	"type": "object",
+	"properties": {
+		"timeDelta": {
+			"type": "number",
+			"description": "Time interval (in seconds) to summarize, ending now.",
+		},
+		"resolution": {
+			"type": ["number", "null"],
+			"description": """
+				Optional bucket width in seconds, fallback to a resolution that
+				keeps the summary short.
+			""",
+		},
+		"device": DEVICE_PARAM,
+	},
+	"required": ["timeDelta", "resolution", "device"],
+	"additionalProperties": False,
+}
+
+# Upper bound on the number of rows in a summary table
+MAX_SUMMARY_BUCKETS = 48
+
+
+def format_summary_table(data: list[SensorBucket]) -> str:
+	"""Format aggregated sensor data as a markdown table."""
+	if not data:
+		return "No sensor data available."
+
+	rows = [
+		"| Time (UTC) | Readings | Temperature avg (min-max) | Gas avg (min-max) |",
+		"|------------|----------|---------------------------|-------------------|",
+	]
+	for bucket in data:
+		timestamp = bucket.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+		rows.append(
+			f"| {timestamp} | {bucket.count} "
+			f"| {bucket.temperature_avg:.2f} ({bucket.temperature_min:.2f}-{bucket.temperature_max:.2f}) "
+			f"| {bucket.gas_avg:.2f} ({bucket.gas_min:.2f}-{bucket.gas_max:.2f}) |"
+		)
+
+	return "\n".join(rows)
+
+
+async def handle_get_sensor_summary(
+	state: AppState, arguments: dict[str, object]
+) -> str:
+	"""Handle get_sensor_summary tool call."""
+	time_delta = arguments.get("timeDelta")
+	if not isinstance(time_delta, (int, float)) or time_delta <= 0:
+		return "Error: 'timeDelta' must be a positive number."
+
+	# Snap to whole minutes so the query is served from the rollup tables
+	min_resolution = max(60, -(-int(time_delta) // MAX_SUMMARY_BUCKETS))
+	min_resolution = -(-min_resolution // 60) * 60
+
+	resolution = min_resolution
+	resolution_val = arguments.get("resolution")
+	if isinstance(resolution_val, (int, float)):
+		resolution = max(int(resolution_val), min_resolution)
+
+	since = utc_now() - timedelta(seconds=time_delta)
+	device_id = device_argument(arguments)
+
+	data = await state.run_db(
+		lambda db: query_buckets(db, device_id, since, resolution)
+	)
+
+	return format_summary_table(data)
+
+
+DEVICE_PARAMS: Final = {
+	"type": "object",
+	"properties": {"device": DEVICE_PARAM},
+	"required": ["device"],
+	"additionalProperties": False,
+}
+
+
+async def handle_get_forecast(state: AppState, arguments: dict[str, object]) -> str:
+	"""Handle get_forecast tool call."""
+	device = state.devices.get(device_argument(arguments))
+	forecast = device.forecaster.latest if device is not None else None
+	if forecast is None:
+		return "Not enough sensor data for a forecast."
+
+	rows = [
+		"| Timestamp (UTC) | Temperature (°C) | Gas Level |",
+		"|-----------------|------------------|-----------|",
+	]
+	for timestamp, temperature, gas in zip(
+		forecast.timestamps, forecast.temperature, forecast.gas
+	):
+		rows.append(
+			f"| {timestamp.strftime('%Y-%m-%d %H:%M:%S')} | {temperature:.2f} | {gas:.2f} |"
+		)
+
+	return "\n".join(rows)
+
+
 # Device control parameter schemas
 BOOL_STATE_PARAMS: Final = {
 	"type": "object",
@@ -159,27 +329,35 @@ BOOL_STATE_PARAMS: Final = {
 	"additionalProperties": False,
 }
 
+DEVICE_STATE_PARAMS: Final = {
+	"type": "object",
+	"properties": {
+		"enabled": {
+			"type": "boolean",
+			"description": "Whether to enable (true) or disable (false) the device.",
+		},
+		"device": DEVICE_PARAM,
+	},
+	"required": ["enabled", "device"],
+	"additionalProperties": False,
+}
+
 
-def handle_set_sensor_polling(state: AppState, arguments: dict[str, object]) -> str:
+async def handle_set_sensor_polling(
+	state: AppState, arguments: dict[str, object]
+) -> str:
 	"""Handle set_sensor_polling tool call."""
 	enabled = arguments.get("enabled")
 	if not isinstance(enabled, bool):
 		return "Error: 'enabled' must be a boolean value."
 
-	current_polling = state.sensor_task is not None
+	current_polling = state.poller.status.running
 
 	if enabled and not current_polling:
-		# Start polling
-		state.sensor_task = start_task(
-			lambda: poll_sensors(state),
-			interval=3.0,
-		)
+		state.poller.set_polling(state, True)
 		return "Sensor polling started."
 	elif not enabled and current_polling:
-		# Stop polling
-		if state.sensor_task is not None:
-			state.sensor_task.cancel()
-			state.sensor_task = None
+		state.poller.set_polling(state, False)
 		return "Sensor polling stopped."
 	elif enabled and current_polling:
 		return "Sensor polling is already running."
@@ -187,23 +365,29 @@ def handle_set_sensor_polling(state: AppState, arguments: dict[str, object]) ->
 		return "Sensor polling is already stopped."
 
 
-def handle_set_relay(state: AppState, arguments: dict[str, object]) -> str:
+async def handle_set_relay(state: AppState, arguments: dict[str, object]) -> str:
 	"""Handle set_relay tool call."""
 	enabled = arguments.get("enabled")
 	if not isinstance(enabled, bool):
 		return "Error: 'enabled' must be a boolean value."
 
-	set_relay(state, enabled)
+	try:
+		await set_relay(state, device_argument(arguments), enabled)
+	except MqttError as e:
+		return f"Error: {e}"
 	return f"Relay {'activated' if enabled else 'deactivated'}."
 
 
-def handle_set_buzzer(state: AppState, arguments: dict[str, object]) -> str:
+async def handle_set_buzzer(state: AppState, arguments: dict[str, object]) -> str:
 	"""Handle set_buzzer tool call."""
 	enabled = arguments.get("enabled")
 	if not isinstance(enabled, bool):
 		return "Error: 'enabled' must be a boolean value."
 
-	set_buzzer(state, enabled)
+	try:
+		await set_buzzer(state, device_argument(arguments), enabled)
+	except MqttError as e:
+		return f"Error: {e}"
 	return f"Buzzer {'activated' if enabled else 'deactivated'}."
 
 
@@ -228,6 +412,26 @@ TOOL_REGISTRY: Final[dict[str, Tool]] = {
 		},
 		handler=handle_get_gas,
 	),
+	"get_sensor_summary": Tool(
+		definition={
+			"type": "function",
+			"name": "get_sensor_summary",
+			"description": "Retrieve average, minimum and maximum temperature and gas readings aggregated over time buckets, suited for long time ranges",
+			"parameters": SUMMARY_PARAMS,
+			"strict": True,
+		},
+		handler=handle_get_sensor_summary,
+	),
+	"get_forecast": Tool(
+		definition={
+			"type": "function",
+			"name": "get_forecast",
+			"description": "Retrieve the predicted temperature and gas readings for the next few sensor polls",
+			"parameters": DEVICE_PARAMS,
+			"strict": True,
+		},
+		handler=handle_get_forecast,
+	),
 	"set_sensor_polling": Tool(
 		definition={
 			"type": "function",
@@ -243,7 +447,7 @@ TOOL_REGISTRY: Final[dict[str, Tool]] = {
 			"type": "function",
 			"name": "set_relay",
 			"description": "Activate or deactivate the water relay/sprinkler for fire suppression",
-			"parameters": BOOL_STATE_PARAMS,
+			"parameters": DEVICE_STATE_PARAMS,
 			"strict": True,
 		},
 		handler=handle_set_relay,
@@ -253,7 +457,7 @@ TOOL_REGISTRY: Final[dict[str, Tool]] = {
 			"type": "function",
 			"name": "set_buzzer",
 			"description": "Activate or deactivate the buzzer alarm",
-			"parameters": BOOL_STATE_PARAMS,
+			"parameters": DEVICE_STATE_PARAMS,
 			"strict": True,
 		},
 		handler=handle_set_buzzer,
@@ -264,7 +468,7 @@ TOOL_REGISTRY: Final[dict[str, Tool]] = {
 TOOLS: Final[list[ToolParam]] = [tool.definition for tool in TOOL_REGISTRY.values()]
 
 
-def handle_tool_call(
+async def handle_tool_call(
 	state: AppState, tool_name: str, arguments: dict[str, object]
 ) -> str:
 	"""Execute a tool call using the registry and return the result."""
@@ -272,27 +476,29 @@ def handle_tool_call(
 	if tool is None:
 		return f"Unknown tool: {tool_name}"
 
-	return tool.handler(state, arguments)
+	device = arguments.get("device")
+	if isinstance(device, str) and device and not valid_device_id(device):
+		return f"Error: invalid device id {device!r}."
 
+	return await tool.handler(state, arguments)
 
-@dataclass
-class ChatResult:
-	"""Result of a chat interaction."""
 
-	messages: list[dict[str, str]]
-	tool_calls: list[dict[str, object]]
+ChatEvent = TextDelta | ChatMessage | ToolCall
 
 
-def chat(state: AppState, messages: list[dict[str, str]]) -> ChatResult:
+async def chat(
+	state: AppState, messages: list[dict[str, str]]
+) -> AsyncIterator[ChatEvent]:
 	"""
-	Process chat messages and return new assistant messages with tool call info.
+	Process chat messages, streaming the assistant's reply as it is generated.
 
 	Args:
 		state: Application state with OpenAI client and database access
 		messages: List of messages in OpenAI format [{role, content}, ...]
 
-	Returns:
-		ChatResult with new messages and tool calls
+	Yields:
+		TextDelta for each chunk of assistant text, ChatMessage once a message
+		is complete, and ToolCall after each tool call has been executed
 	"""
 	client = state.openai_client
 
@@ -302,63 +508,77 @@ def chat(state: AppState, messages: list[dict[str, str]]) -> ChatResult:
 		*messages,
 	]
 
-	new_messages: list[dict[str, str]] = []
-	tool_calls: list[dict[str, object]] = []
 	max_iterations = 20
 
 	for _ in range(max_iterations):
-		response = client.responses.create(
+		stream = await client.responses.create(
 			model=MODEL,
 			tools=TOOLS,
 			input=inputs,
+			stream=True,
 		)
 
-		has_tool_calls = False
-
-		for output in response.output:
-			if output.type == "function_call":
-				has_tool_calls = True
-
-				# Parse and execute tool call
-				arguments = json.loads(output.arguments)
-				result = handle_tool_call(state, output.name, arguments)
-
-				# Track tool call for frontend
-				tool_calls.append(
-					{
-						"name": output.name,
-						"arguments": arguments,
-						"output": result,
-					}
-				)
-
-				# Add tool call and result to inputs for next iteration
-				inputs.append(output)
-				inputs.append(
-					{
-						"type": "function_call_output",
-						"call_id": output.call_id,
-						"output": result,
-					}
-				)
-
-			elif output.type == "message":
-				# Extract text content from message
-				content_parts = []
-				for cnt in output.content:
-					if cnt.type == "output_text":
-						content_parts.append(cnt.text)
-					elif cnt.type == "refusal":
-						content_parts.append(cnt.refusal)
-
-				message_content = "\n\n".join(content_parts)
-				new_message = {"role": output.role, "content": message_content}
-
-				inputs.append(new_message)
-				new_messages.append(new_message)
+		# Tool calls are started as soon as the model has emitted them, so
+		# independent calls of the same turn run concurrently
+		function_calls: list[
+			tuple[ResponseFunctionToolCall, dict[str, object], asyncio.Task[str]]
+		] = []
+
+		try:
+			async for event in stream:
+				if event.type == "response.output_text.delta":
+					yield TextDelta(text=event.delta)
+
+				elif event.type == "response.output_item.done":
+					output = event.item
+					if output.type == "function_call":
+						arguments = json.loads(output.arguments)
+						task = asyncio.create_task(
+							handle_tool_call(state, output.name, arguments)
+						)
+						function_calls.append((output, arguments, task))
+
+					elif output.type == "message":
+						# Extract text content from message
+						content_parts = []
+						for cnt in output.content:
+							if cnt.type == "output_text":
+								content_parts.append(cnt.text)
+							elif cnt.type == "refusal":
+								content_parts.append(cnt.refusal)
+
+						message_content = "\n\n".join(content_parts)
+						inputs.append({"role": output.role, "content": message_content})
+						if message_content.strip():
+							yield ChatMessage(role=output.role, content=message_content)
+
+				elif event.type == "error":
+					raise ChatError(event.message)
+
+				elif event.type == "response.failed":
+					error = event.response.error
+					raise ChatError(error.message if error else "Response failed")
+
+			results = await asyncio.gather(*(task for _, _, task in function_calls))
+		finally:
+			for _, _, task in function_calls:
+				task.cancel()
+
+		# Results are reported in call order
+		for (output, arguments, _), result in zip(function_calls, results):
+			# Add tool call and result to inputs for next iteration
+			inputs.append(output)
+			inputs.append(
+				{
+					"type": "function_call_output",
+					"call_id": output.call_id,
+					"output": result,
+				}
+			)
+
+			# Report tool call to frontend
+			yield ToolCall(name=output.name, arguments=arguments, output=result)
 
 		# If no tool calls, we're done
-		if not has_tool_calls:
+		if not function_calls:
 			break
-
-	return ChatResult(messages=new_messages, tool_calls=tool_calls)
@@ -1,40 +1,96 @@
+from pydantic import ValidationError
 from starlette.requests import Request
 from starlette.responses import JSONResponse, Response
 from starlette.routing import BaseRoute, Mount, Route
 
+from backend.models import to_iso
+from backend.modules.auth.auth_controller import strip_prefix
 from backend.modules.auth.auth_service import get_user
-from backend.modules.dashboard.dashboard_service import get_sensor_data
+from backend.modules.dashboard.dashboard_models import DashboardQuery, DeviceQuery
+from backend.modules.dashboard.dashboard_service import (
+	bucket_resolution,
+	get_sensor_data,
+)
 from backend.modules.dashboard.devices_control import devices_controller
 from backend.modules.dashboard.poll_control import poll_control_controller
 from backend.state import AppState
 
 
 async def handle_dashboard(request: Request) -> Response:
-	user = get_user(request)
+	user = await get_user(request)
 	if user is None:
 		return Response(status_code=401)
 
+	try:
+		query = DashboardQuery(**request.query_params)
+	except ValidationError as e:
+		first_error = e.errors()[0]
+		error_msg = first_error.get("msg", str(e))
+		error_msg = strip_prefix(error_msg, "Value error, ")
+		return Response(error_msg, status_code=400)
+
 	state = AppState.get(request)
-	sensor_data = get_sensor_data(state, days=3)
+	resolution = bucket_resolution(query.days, query.resolution)
+	sensor_data = await get_sensor_data(state, query.device, query.days, resolution)
 
 	return JSONResponse(
 		{
 			"username": user.email,
+			"device": query.device,
+			"devices": sorted(state.devices),
+			"resolution": resolution,
 			"sensor_data": [
 				{
-					"id": datapoint.id,
-					"timestamp": datapoint.timestamp.isoformat(),
-					"temperature": datapoint.temperature,
-					"gas": datapoint.gas,
+					"id": bucket.id,
+					"timestamp": to_iso(bucket.timestamp),
+					"count": bucket.count,
+					"temperature": bucket.temperature_avg,
+					"temperature_min": bucket.temperature_min,
+					"temperature_max": bucket.temperature_max,
+					"gas": bucket.gas_avg,
+					"gas_min": bucket.gas_min,
+					"gas_max": bucket.gas_max,
 				}
-				for datapoint in sensor_data
+				for bucket in sensor_data
 			],
 		}
 	)
 
 
+async def handle_forecast(request: Request) -> Response:
+	"""Get the forecast for the next few sensor readings"""
+	user = await get_user(request)
+	if user is None:
+		return Response(status_code=401)
+
+	try:
+		query = DeviceQuery(**request.query_params)
+	except ValidationError as e:
+		first_error = e.errors()[0]
+		error_msg = first_error.get("msg", str(e))
+		error_msg = strip_prefix(error_msg, "Value error, ")
+		return Response(error_msg, status_code=400)
+
+	state = AppState.get(request)
+	device = state.devices.get(query.device)
+	forecast = device.forecaster.latest if device is not None else None
+	if forecast is None:
+		return JSONResponse({"forecast": None})
+
+	return JSONResponse(
+		{
+			"forecast": {
+				"timestamps": [to_iso(timestamp) for timestamp in forecast.timestamps],
+				"temperature": forecast.temperature,
+				"gas": forecast.gas,
+			}
+		}
+	)
+
+
 routes: list[BaseRoute] = [
 	Route("/", handle_dashboard, methods=["GET"]),
+	Route("/forecast", handle_forecast, methods=["GET"]),
 	Mount("/poll", routes=poll_control_controller.routes),
 	Mount("/devices", routes=devices_controller.routes),
 ]
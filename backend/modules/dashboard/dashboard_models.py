@@ -0,0 +1,26 @@
+from pydantic import BaseModel, Field, field_validator
+
+from backend.devices import MAX_DEVICE_ID_LENGTH, valid_device_id
+from backend.models import DEFAULT_DEVICE
+
+
+class DeviceQuery(BaseModel):
+	"""Selects the sensor board a query is about"""
+
+	device: str = Field(
+		default=DEFAULT_DEVICE, min_length=1, max_length=MAX_DEVICE_ID_LENGTH
+	)
+
+	@field_validator("device")
+	@classmethod
+	def validate_device(cls, v: str) -> str:
+		if not valid_device_id(v):
+			raise ValueError("Invalid device id")
+		return v
+
+
+class DashboardQuery(DeviceQuery):
+	"""Dashboard history query parameters"""
+
+	days: int = Field(default=3, ge=1, le=30)
+	resolution: int | None = Field(default=None, ge=1)
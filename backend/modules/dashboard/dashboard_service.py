@@ -1,18 +1,43 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from backend.models import SensorData
+from backend.models import utc_now
+from backend.ring_buffer import aggregate
+from backend.rollups import SensorBucket, query_buckets
 from backend.state import AppState
 
+# Upper bound on the number of buckets returned for a single history query
+MAX_BUCKETS = 2000
 
-def get_sensor_data(state: AppState, days: int = 3) -> list[SensorData]:
-	n_days_ago = datetime.now() - timedelta(days=days)
+# Bucket widths (in seconds) picked when the requested one is too fine, these
+# line up with the minute/hour/day rollups so the query never hits raw rows
+RESOLUTIONS = [60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 43200, 86400]
 
-	with state.get_db() as db:
-		sensor_data = (
-			db.query(SensorData)
-			.filter(SensorData.timestamp >= n_days_ago)
-			.order_by(SensorData.timestamp.asc())
-			.all()
-		)
 
-		return sensor_data
+def bucket_resolution(days: int, resolution: int | None) -> int:
+	"""Clamp the requested bucket width (in seconds) to at most MAX_BUCKETS."""
+	min_resolution = -(-days * 86400 // MAX_BUCKETS)
+	if resolution is not None and resolution >= min_resolution:
+		return resolution
+
+	for candidate in RESOLUTIONS:
+		if candidate >= min_resolution:
+			return candidate
+
+	return min_resolution
+
+
+async def get_sensor_data(
+	state: AppState, device_id: str, days: int, resolution: int
+) -> list[SensorBucket]:
+	n_days_ago = utc_now() - timedelta(days=days)
+
+	# Served from memory when the device's buffer reaches back far enough
+	device = state.devices.get(device_id)
+	if device is not None:
+		window = device.buffer.since(n_days_ago)
+		if window is not None:
+			return aggregate(window, resolution)
+
+	return await state.run_db(
+		lambda db: query_buckets(db, device_id, n_days_ago, resolution)
+	)
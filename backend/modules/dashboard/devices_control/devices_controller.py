@@ -1,3 +1,4 @@
+from aiomqtt import MqttError
 from pydantic import ValidationError
 from starlette.requests import Request
 from starlette.responses import JSONResponse, Response
@@ -19,7 +20,7 @@ from backend.state import AppState
 
 
 async def handle_set_relay(request: Request) -> Response:
-	if get_user(request) is None:
+	if await get_user(request) is None:
 		return Response(status_code=401)
 
 	try:
@@ -27,7 +28,7 @@ async def handle_set_relay(request: Request) -> Response:
 		state_relay = StateRelay(**payload)
 
 		state = AppState.get(request)
-		set_relay(state, state_relay.onRelay)
+		await set_relay(state, state_relay.device, state_relay.onRelay)
 
 		return JSONResponse({"onRelay": state_relay.onRelay})
 
@@ -36,10 +37,12 @@ async def handle_set_relay(request: Request) -> Response:
 		error_msg = first_error.get("msg", str(e))
 		error_msg = strip_prefix(error_msg, "Value error, ")
 		return Response(error_msg, status_code=400)
+	except MqttError:
+		return Response("Device broker unavailable", status_code=503)
 
 
 async def handle_set_buzzer(request: Request) -> Response:
-	if get_user(request) is None:
+	if await get_user(request) is None:
 		return Response(status_code=401)
 
 	try:
@@ -47,7 +50,7 @@ async def handle_set_buzzer(request: Request) -> Response:
 		state_buzzer = StateBuzzer(**payload)
 
 		state = AppState.get(request)
-		set_buzzer(state, state_buzzer.onBuzzer)
+		await set_buzzer(state, state_buzzer.device, state_buzzer.onBuzzer)
 
 		return JSONResponse({"onRelay": state_buzzer.onBuzzer})
 
@@ -56,10 +59,12 @@ async def handle_set_buzzer(request: Request) -> Response:
 		error_msg = first_error.get("msg", str(e))
 		error_msg = strip_prefix(error_msg, "Value error, ")
 		return Response(error_msg, status_code=400)
+	except MqttError:
+		return Response("Device broker unavailable", status_code=503)
 
 
 async def handle_set_led_color(request: Request) -> Response:
-	if get_user(request) is None:
+	if await get_user(request) is None:
 		return Response(status_code=401)
 
 	try:
@@ -67,7 +72,7 @@ async def handle_set_led_color(request: Request) -> Response:
 		state_led = StateLed(**payload)
 
 		state = AppState.get(request)
-		set_led_color(state, state_led.ledColor)
+		await set_led_color(state, state_led.device, state_led.ledColor)
 
 		return JSONResponse({"onRelay": state_led.ledColor})
 
@@ -76,6 +81,8 @@ async def handle_set_led_color(request: Request) -> Response:
 		error_msg = first_error.get("msg", str(e))
 		error_msg = strip_prefix(error_msg, "Value error, ")
 		return Response(error_msg, status_code=400)
+	except MqttError:
+		return Response("Device broker unavailable", status_code=503)
 
 
 routes: list[BaseRoute] = [
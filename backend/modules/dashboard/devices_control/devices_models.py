@@ -1,21 +1,39 @@
 from typing import Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 
+from backend.devices import MAX_DEVICE_ID_LENGTH, valid_device_id
+from backend.models import DEFAULT_DEVICE
 
-class StateBuzzer(BaseModel):
+
+class DeviceCommand(BaseModel):
+	"""Command sent to one sensor board"""
+
+	device: str = Field(
+		default=DEFAULT_DEVICE, min_length=1, max_length=MAX_DEVICE_ID_LENGTH
+	)
+
+	@field_validator("device")
+	@classmethod
+	def validate_device(cls, v: str) -> str:
+		if not valid_device_id(v):
+			raise ValueError("Invalid device id")
+		return v
+
+
+class StateBuzzer(DeviceCommand):
 	"""State Buzzer"""
 
 	onBuzzer: bool
 
 
-class StateRelay(BaseModel):
+class StateRelay(DeviceCommand):
 	"""State Relay"""
 
 	onRelay: bool
 
 
-class StateLed(BaseModel):
+class StateLed(DeviceCommand):
 	"""State Led"""
 
 	ledColor: Literal["red", "yellow", "green"]
@@ -1,13 +1,14 @@
+from backend.devices import control_topic
 from backend.state import AppState
 
 
-def set_relay(state: AppState, on_relay: bool) -> None:
-	state.mqtt_client.publish("relay", on_relay)
+async def set_relay(state: AppState, device_id: str, on_relay: bool) -> None:
+	await state.mqtt.publish(control_topic(device_id, "relay"), on_relay)
 
 
-def set_buzzer(state: AppState, on_buzzer: bool) -> None:
-	state.mqtt_client.publish("buzzer", on_buzzer)
+async def set_buzzer(state: AppState, device_id: str, on_buzzer: bool) -> None:
+	await state.mqtt.publish(control_topic(device_id, "buzzer"), on_buzzer)
 
 
-def set_led_color(state: AppState, led_color: str) -> None:
-	state.mqtt_client.publish("led", led_color)
+async def set_led_color(state: AppState, device_id: str, led_color: str) -> None:
+	await state.mqtt.publish(control_topic(device_id, "led"), led_color)
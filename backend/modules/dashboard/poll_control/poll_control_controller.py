@@ -3,42 +3,31 @@ from starlette.responses import JSONResponse, Response
 from starlette.routing import BaseRoute, Route
 
 from backend.modules.auth.auth_service import get_user
-from backend.state import AppState, start_task
-from backend.tasks.poll_sensors import poll_sensors
+from backend.state import AppState
 
 
 async def handle_get_poll_status(request: Request) -> Response:
 	"""Get the polling task status"""
-	user = get_user(request)
+	user = await get_user(request)
 	if user is None:
 		return Response(status_code=401)
 
 	state = AppState.get(request)
-	is_polling = state.sensor_task is not None
 
-	return JSONResponse({"is_polling": is_polling})
+	status = state.poller.status
+	return JSONResponse({"is_polling": status.running, "intervals": status.intervals})
 
 
 async def handle_toggle_polling(request: Request) -> Response:
 	"""Toggle the polling task on/off"""
-	user = get_user(request)
+	user = await get_user(request)
 	if user is None:
 		return Response(status_code=401)
 
 	state = AppState.get(request)
 
-	if state.sensor_task is None:
-		# Start polling
-		state.sensor_task = start_task(
-			lambda: poll_sensors(state),
-			interval=3.0,  # Poll every 3 seconds
-		)
-		is_polling = True
-	else:
-		# Stop polling
-		state.sensor_task.cancel()
-		state.sensor_task = None
-		is_polling = False
+	is_polling = not state.poller.status.running
+	state.poller.set_polling(state, is_polling)
 
 	return JSONResponse(
 		{
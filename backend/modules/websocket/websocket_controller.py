@@ -1,38 +1,106 @@
+import json
+
+from pydantic import ValidationError
 from starlette.routing import BaseRoute, WebSocketRoute
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
+from backend.devices import valid_device_id
+from backend.models import DEFAULT_DEVICE
 from backend.modules.auth.auth_service import get_user
+from backend.modules.websocket.websocket_models import Subscription
+from backend.modules.websocket.websocket_service import (
+	RESYNC_MESSAGE,
+	WS_REPLAY_FRAME_SIZE,
+	WebSocketClient,
+	missed_readings,
+	negotiate_protocol,
+	stored_readings,
+)
 from backend.state import AppState
+from backend.tasks.ingest_sensors import SensorRow
+
+
+async def open_client(
+	state: AppState, websocket: WebSocket, protocol: str | None
+) -> WebSocketClient | None:
+	"""Authenticate and create the client, None if the socket was closed."""
+	user = await get_user(websocket)
+	if user is None:
+		await websocket.close(code=1008, reason="Unauthorized")
+		return None
+
+	device_id = websocket.query_params.get("device", DEFAULT_DEVICE)
+	if not valid_device_id(device_id):
+		await websocket.close(code=1008, reason="Invalid device")
+		return None
+
+	return WebSocketClient(websocket, protocol, device_id)
+
+
+def prepare_replay(
+	state: AppState, client: WebSocketClient, since: int, stored: list[SensorRow]
+) -> None:
+	rows = missed_readings(state, client.device_id, since, stored)
+	if rows is None:
+		client.replay.append(RESYNC_MESSAGE)
+	else:
+		client.replay.extend(
+			client.encode(rows[i : i + WS_REPLAY_FRAME_SIZE])
+			for i in range(0, len(rows), WS_REPLAY_FRAME_SIZE)
+		)
 
 
 async def websocket_endpoint(websocket: WebSocket) -> None:
 	"""
 	WebSocket endpoint for real-time sensor data updates.
 	Uses cookie-based authentication.
+
+	The connection follows the device passed as `?device=`, the default board
+	otherwise. Reconnecting clients pass the last reading id they received as
+	`?since=`, and get the readings they missed before the live ones. Clients
+	may send a subscription message at any time to switch device, or to filter
+	and throttle what they receive.
 	"""
-	await websocket.accept()
+	protocol = negotiate_protocol(websocket)
+	await websocket.accept(subprotocol=protocol)
 
-	# Authenticate user
-	user = get_user(websocket)
-	if user is None:
-		await websocket.close(code=1008, reason="Unauthorized")
-		return
+	since = websocket.query_params.get("since")
+	replay_since = int(since) if since is not None and since.isdigit() else None
 
-	# Get app state and register connection
+	# The handshake's queries share one session, released before streaming
 	state = AppState.get(websocket)
-	state.ws_connections.add(websocket)
+	async with state.db_scope():
+		client = await open_client(state, websocket, protocol)
+		stored: list[SensorRow] = []
+		if client is not None and replay_since is not None:
+			stored = await stored_readings(state, client.device_id, replay_since)
+	if client is None:
+		return
+
+	# Nothing may yield between reading the buffer and registering the client,
+	# or readings committed meanwhile would reach it neither way
+	if replay_since is not None:
+		prepare_replay(state, client, replay_since, stored)
+	state.ws_connections.add(client)
+	client.start(state)
 
 	try:
-		# Keep connection alive and listen for close
 		while True:
-			# Wait for any message (we don't process them, just keep alive)
-			await websocket.receive_text()
+			message = await websocket.receive_text()
+			try:
+				client.subscribe(Subscription.model_validate_json(message))
+			except ValidationError as e:
+				error_msg = e.errors()[0].get("msg", str(e))
+				client.send(json.dumps({"type": "error", "message": error_msg}))
 	except WebSocketDisconnect:
-		# Remove connection when closed
-		state.ws_connections.discard(websocket)
+		pass
 	except Exception as e:
 		print(f"WebSocket error: {e}")
-		state.ws_connections.discard(websocket)
+	finally:
+		# Remove connection when closed
+		state.ws_connections.discard(client)
+		if client.task is not None:
+			client.task.cancel()
 
 
 routes: list[BaseRoute] = [WebSocketRoute("/ws", websocket_endpoint)]
@@ -0,0 +1,40 @@
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+from backend.devices import MAX_DEVICE_ID_LENGTH, valid_device_id
+
+SensorField = Literal["temperature", "gas"]
+
+
+class Thresholds(BaseModel):
+	"""Limits for threshold-only subscriptions"""
+
+	model_config = ConfigDict(frozen=True)
+
+	temperature: float | None = None
+	gas: float | None = None
+
+
+class Subscription(BaseModel):
+	"""Subscription sent by WebSocket clients to choose what they receive"""
+
+	model_config = ConfigDict(frozen=True)
+
+	type: Literal["subscribe"] = "subscribe"
+	# Switches the connection to another sensor board, None keeps the current one
+	device: str | None = Field(
+		default=None, min_length=1, max_length=MAX_DEVICE_ID_LENGTH
+	)
+	fields: tuple[SensorField, ...] = Field(
+		default=("temperature", "gas"), min_length=1
+	)
+	max_rate: float | None = Field(default=None, gt=0)
+	thresholds: Thresholds | None = None
+
+	@field_validator("device")
+	@classmethod
+	def validate_device(cls, v: str | None) -> str | None:
+		if v is not None and not valid_device_id(v):
+			raise ValueError("Invalid device id")
+		return v
@@ -2,42 +2,503 @@ from __future__ import annotations
 
 import asyncio
 import json
-from typing import TYPE_CHECKING, TypedDict
+import math
+import struct
+from collections.abc import Iterable
+from contextlib import suppress
+from os import environ as env
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from backend.forecast import Forecast
+from backend.models import DEFAULT_DEVICE, SensorData, to_iso
+from backend.modules.websocket.websocket_models import SensorField, Subscription
 
 if TYPE_CHECKING:
 	from backend.state import AppState
+	from backend.tasks.ingest_sensors import SensorRow
+
+WS_QUEUE_SIZE = int(env.get("WS_QUEUE_SIZE", "64"))
+WS_MAX_LAG = float(env.get("WS_MAX_LAG", "30"))
+WS_SEND_TIMEOUT = float(env.get("WS_SEND_TIMEOUT", "10"))
+
+# Readings arriving within this many seconds are sent in one frame, 0 sends
+# every ingest batch as soon as it is committed
+WS_BATCH_WINDOW = float(env.get("WS_BATCH_WINDOW", "0"))
+
+# Reconnecting clients missing more readings than this reload their history
+WS_REPLAY_LIMIT = int(env.get("WS_REPLAY_LIMIT", "10000"))
+WS_REPLAY_FRAME_SIZE = 1000
+
+# Tells the client its history can't be resumed and must be fetched again
+RESYNC_MESSAGE = json.dumps({"type": "resync"})
+
+# Subprotocols offered to clients, in order of preference
+JSON_PROTOCOL = "sensor.v1.json"
+BINARY_PROTOCOL = "sensor.v1.binary"
+PROTOCOLS = [BINARY_PROTOCOL, JSON_PROTOCOL]
+
+# Binary frames are packed little endian records of
+# (id int64, timestamp int64 unix milliseconds, temperature float32, gas float32),
+# fields left out of the subscription are NaN
+BINARY_RECORD = struct.Struct("<qqff")
+
+# Closes of disconnected clients in flight, referenced until they complete
+pending_closes: set[asyncio.Task[None]] = set()
+
+
+def negotiate_protocol(websocket: WebSocket) -> str | None:
+	"""Pick the preferred subprotocol the client offered, if any."""
+	offered = websocket.scope.get("subprotocols", [])
+	for protocol in PROTOCOLS:
+		if protocol in offered:
+			return protocol
+	return None
+
+
+DEFAULT_SUBSCRIPTION = Subscription()
+
+
+def forecast_fields(
+	forecast: Forecast, fields: tuple[SensorField, ...]
+) -> dict[str, list[str] | list[float]]:
+	data: dict[str, list[str] | list[float]] = {
+		"timestamps": [to_iso(timestamp) for timestamp in forecast.timestamps]
+	}
+	if "temperature" in fields:
+		data["temperature"] = forecast.temperature
+	if "gas" in fields:
+		data["gas"] = forecast.gas
+	return data
+
+
+def encode_forecast(
+	device_id: str, forecast: Forecast, fields: tuple[SensorField, ...]
+) -> str:
+	return json.dumps(
+		{"type": "forecast", "device": device_id, **forecast_fields(forecast, fields)},
+		separators=(",", ":"),
+	)
+
+
+def encode_json(
+	device_id: str,
+	rows: list[SensorRow],
+	fields: tuple[SensorField, ...] = DEFAULT_SUBSCRIPTION.fields,
+	forecast: Forecast | None = None,
+) -> str:
+	readings = []
+	for id, timestamp, temperature, gas in rows:
+		reading: dict[str, int | float | str] = {
+			"id": id,
+			"timestamp": to_iso(timestamp),
+		}
+		if "temperature" in fields:
+			reading["temperature"] = temperature
+		if "gas" in fields:
+			reading["gas"] = gas
+		readings.append(reading)
+
+	frame: dict[str, object] = {
+		"type": "readings",
+		"device": device_id,
+		"readings": readings,
+	}
+	if forecast is not None:
+		frame["forecast"] = forecast_fields(forecast, fields)
+	return json.dumps(frame, separators=(",", ":"))
+
+
+def encode_binary(
+	rows: list[SensorRow], fields: tuple[SensorField, ...] = DEFAULT_SUBSCRIPTION.fields
+) -> bytes:
+	with_temperature = "temperature" in fields
+	with_gas = "gas" in fields
+
+	buffer = bytearray(BINARY_RECORD.size * len(rows))
+	for i, (id, _, temperature, gas) in enumerate(rows):
+		# A reading's id is its timestamp in epoch milliseconds
+		BINARY_RECORD.pack_into(
+			buffer,
+			i * BINARY_RECORD.size,
+			id,
+			id,
+			temperature if with_temperature else math.nan,
+			gas if with_gas else math.nan,
+		)
+	return bytes(buffer)
+
+
+class WebSocketClient:
+	"""
+	A connected WebSocket client with a bounded send queue drained by its own
+	writer task, so a slow client never holds up the others. When the queue is
+	full the oldest message is dropped, and a client that keeps falling behind
+	for more than WS_MAX_LAG seconds is disconnected.
+
+	Each client follows the readings of one device, filtered through its
+	subscription before encoding.
+	"""
+
+	def __init__(
+		self,
+		websocket: WebSocket,
+		protocol: str | None = None,
+		device_id: str = DEFAULT_DEVICE,
+		queue_size: int = WS_QUEUE_SIZE,
+	) -> None:
+		self.websocket = websocket
+		self.binary = protocol == BINARY_PROTOCOL
+		self.queue: asyncio.Queue[str | bytes] = asyncio.Queue(queue_size)
+		self.replay: list[str | bytes] = []
+		self.dropped = 0
+		self.lagging_since: float | None = None
+		self.task: asyncio.Task[None] | None = None
+
+		self.device_id = device_id
+		self.subscription = DEFAULT_SUBSCRIPTION
+		self.above: dict[SensorField, bool] = {}
+		self.next_send = 0.0
+		# Newest reading skipped by max_rate, sent once the interval is over
+		self.held: SensorRow | None = None
+		self.held_timer: asyncio.TimerHandle | None = None
+
+	def start(self, state: AppState) -> None:
+		self.task = asyncio.create_task(self.run(state))
+
+	def subscribe(self, subscription: Subscription) -> None:
+		if subscription.device is not None:
+			self.device_id = subscription.device
+		self.subscription = subscription
+		self.above = {}
+		self.next_send = 0.0
+		self.held = None
+
+	def encode(
+		self, rows: list[SensorRow], forecast: Forecast | None = None
+	) -> str | bytes:
+		"""
+		Encode rows in the client's format, JSON frames carry the forecast with
+		them while binary clients get it in a separate frame.
+		"""
+		fields = self.subscription.fields
+		if self.binary:
+			return encode_binary(rows, fields)
+		return encode_json(self.device_id, rows, fields, forecast)
+
+	def crossed(self, row: SensorRow) -> bool:
+		"""Whether a reading moves any field across its threshold, either way."""
+		thresholds = self.subscription.thresholds
+		assert thresholds is not None
+
+		_, _, temperature, gas = row
+		crossed = False
+		for field, value, limit in (
+			("temperature", temperature, thresholds.temperature),
+			("gas", gas, thresholds.gas),
+		):
+			if limit is None:
+				continue
+			above = value >= limit
+			crossed |= above != self.above.get(field, False)
+			self.above[field] = above
+		return crossed
+
+	def select(self, rows: list[SensorRow]) -> list[SensorRow]:
+		"""
+		The rows this client should receive. With a max_rate, readings arriving
+		faster are held back and each frame carries only the newest one, the
+		newest one held is left in `held` to send when the interval is over.
+		Returns `rows` itself when nothing was filtered out.
+		"""
+		subscription = self.subscription
+		if subscription.thresholds is not None:
+			rows = [row for row in rows if self.crossed(row)]
+
+		if subscription.max_rate is None or not rows:
+			return rows
+
+		now = monotonic()
+		if now < self.next_send:
+			self.held = rows[-1]
+			return []
+		self.next_send = now + 1 / subscription.max_rate
+		self.held = None
+		return rows[-1:]
+
+	def release(self) -> list[SensorRow]:
+		"""The held reading, if any, once the max_rate interval is over."""
+		self.held_timer = None
+		max_rate = self.subscription.max_rate
+		if self.held is None or max_rate is None:
+			return []
+
+		rows = [self.held]
+		self.held = None
+		self.next_send = monotonic() + 1 / max_rate
+		return rows
+
+	def send(self, message: str | bytes) -> bool:
+		"""
+		Queue a message without blocking. Returns False when the client has
+		been lagging for too long and should be disconnected.
+		"""
+		if self.queue.full():
+			self.queue.get_nowait()
+			self.dropped += 1
+
+			now = monotonic()
+			if self.lagging_since is None:
+				self.lagging_since = now
+			elif now - self.lagging_since > WS_MAX_LAG:
+				return False
+
+		self.queue.put_nowait(message)
+		return True
+
+	async def run(self, state: AppState) -> None:
+		try:
+			# Readings missed while disconnected go out before live ones
+			for message in self.replay:
+				await self.write(message)
+			self.replay.clear()
 
+			while True:
+				await self.write(await self.queue.get())
+				if self.queue.empty():
+					self.lagging_since = None
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			print(f"Failed to send to WebSocket: {e}")
+			state.ws_connections.discard(self)
+			# Lets the client reconnect and replay what it missed
+			await self.close(1011, "Send failed")
 
-class SensorDataDict(TypedDict):
-	id: int
-	timestamp: str
-	temperature: float
-	gas: float
+	async def write(self, message: str | bytes) -> None:
+		if isinstance(message, bytes):
+			sending = self.websocket.send_bytes(message)
+		else:
+			sending = self.websocket.send_text(message)
+		await asyncio.wait_for(sending, WS_SEND_TIMEOUT)
 
+	async def close(self, code: int, reason: str) -> None:
+		if self.held_timer is not None:
+			self.held_timer.cancel()
+			self.held_timer = None
+		if self.task is not None and self.task is not asyncio.current_task():
+			self.task.cancel()
+		# Already closed, by us or by the other end
+		with suppress(RuntimeError, WebSocketDisconnect):
+			await self.websocket.close(code=code, reason=reason)
 
-async def broadcast_sensor_data(state: AppState, data: SensorDataDict) -> None:
+
+def broadcast_sensor_data(
+	state: AppState, device_id: str, rows: list[SensorRow]
+) -> None:
 	"""
-	Broadcast sensor data to all connected WebSocket clients.
-	Removes closed connections from the set.
+	Queue one frame holding a device's `rows`, filtered by each client's
+	subscription, for every WebSocket client following that device. Each
+	distinct frame is encoded at most once and shared by all clients
+	receiving it. Disconnects clients that have been falling behind for too
+	long.
 	"""
-	if not state.ws_connections:
+	if not state.ws_connections or not rows:
 		return
 
-	message = json.dumps(data)
+	forecast = latest_forecast(state, device_id)
+	encoded: dict[tuple, str | bytes] = {}
+	lagging: list[WebSocketClient] = []
+
+	for client in state.ws_connections:
+		if client.device_id != device_id:
+			continue
+
+		selected = client.select(rows)
+		if client.held is not None and client.held_timer is None:
+			loop = asyncio.get_running_loop()
+			client.held_timer = loop.call_later(
+				client.next_send - monotonic(), send_held, state, client
+			)
+		if not selected:
+			continue
+
+		if not queue_rows(client, selected, selected is rows, forecast, encoded):
+			lagging.append(client)
+
+	disconnect_lagging(state, lagging)
+
 
-	# Gather all send operations
-	results = await asyncio.gather(
-		*(connection.send_text(message) for connection in state.ws_connections),
-		return_exceptions=True,
+def latest_forecast(state: AppState, device_id: str) -> Forecast | None:
+	device = state.devices.get(device_id)
+	return device.forecaster.latest if device is not None else None
+
+
+def queue_rows(
+	client: WebSocketClient,
+	rows: list[SensorRow],
+	shared: bool,
+	forecast: Forecast | None,
+	encoded: dict[tuple, str | bytes],
+) -> bool:
+	"""
+	Queue a frame of `rows` and the forecast for a client, reusing the frames
+	in `encoded` already encoded for other clients. `shared` rows are the
+	whole batch rather than a selection of it. Returns False when the client
+	should be disconnected.
+	"""
+	key = (
+		client.binary,
+		client.subscription.fields,
+		None if shared else tuple(row[0] for row in rows),
 	)
+	message = encoded.get(key)
+	if message is None:
+		message = encoded[key] = client.encode(rows, forecast)
+
+	if not client.send(message):
+		return False
+
+	if client.binary and forecast is not None:
+		key = ("forecast", client.subscription.fields)
+		message = encoded.get(key)
+		if message is None:
+			message = encoded[key] = encode_forecast(
+				client.device_id, forecast, client.subscription.fields
+			)
+		client.send(message)
+	return True
+
+
+def send_held(state: AppState, client: WebSocketClient) -> None:
+	"""Send the reading a throttled client held back, once it may."""
+	rows = client.release()
+	if not rows or client not in state.ws_connections:
+		return
+
+	forecast = latest_forecast(state, client.device_id)
+	if not queue_rows(client, rows, False, forecast, {}):
+		disconnect_lagging(state, [client])
+
+
+def broadcast_message(state: AppState, message: str) -> None:
+	"""Queue a message for every client regardless of its subscription."""
+	lagging = [client for client in state.ws_connections if not client.send(message)]
+	disconnect_lagging(state, lagging)
+
+
+def disconnect_lagging(state: AppState, lagging: list[WebSocketClient]) -> None:
+	for client in lagging:
+		print(f"Disconnecting WebSocket client, {client.dropped} messages dropped")
+		state.ws_connections.discard(client)
+		task = asyncio.create_task(client.close(code=1013, reason="Client too slow"))
+		pending_closes.add(task)
+		task.add_done_callback(pending_closes.discard)
+
+
+def select_rows_after(
+	db: Session, device_id: str, since: int, limit: int
+) -> list[SensorRow]:
+	rows = db.execute(
+		select(
+			SensorData.id,
+			SensorData.timestamp,
+			SensorData.temperature,
+			SensorData.gas,
+		)
+		.where(SensorData.device_id == device_id, SensorData.id > since)
+		.order_by(SensorData.id)
+		.limit(limit)
+	).all()
+
+	return [
+		(id, timestamp, temperature, gas) for id, timestamp, temperature, gas in rows
+	]
+
+
+async def stored_readings(
+	state: AppState, device_id: str, since: int
+) -> list[SensorRow]:
+	"""
+	Readings of a device after the id `since` that are older than its buffer,
+	from the database. Empty when the buffer holds every reading after `since`.
+	"""
+	device = state.devices.get(device_id)
+	if device is None or device.buffer.after(since) is not None:
+		return []
+
+	return await state.run_db(
+		lambda db: select_rows_after(db, device_id, since, WS_REPLAY_LIMIT + 1)
+	)
+
+
+def missed_readings(
+	state: AppState, device_id: str, since: int, stored: list[SensorRow]
+) -> list[SensorRow] | None:
+	"""
+	Readings of a device a reconnecting client missed after the id `since`:
+	the `stored_readings` fetched for it, followed by the device's buffer.
+	None when there are too many to replay.
+
+	This doesn't yield to the event loop, so a client registered right after
+	it neither misses nor repeats any live broadcast.
+	"""
+	device = state.devices.get(device_id)
+	if device is None:
+		# Nothing was ever committed for the device while this worker ran
+		return []
+
+	rows = list(stored)
+	if rows:
+		since = rows[-1][0]
+
+	window = device.buffer.after(since)
+	if window is None:
+		return None
+	rows += window.rows()
+
+	# Rows still waiting in the broadcaster will reach the client live
+	pending = state.broadcaster.pending.get(device_id)
+	if pending:
+		rows = [row for row in rows if row[0] < pending[0][0]]
+
+	if len(rows) > WS_REPLAY_LIMIT:
+		return None
+	return rows
+
+
+class SensorBroadcaster:
+	"""
+	Coalesces committed readings over WS_BATCH_WINDOW seconds so that bursts
+	reach clients as a few large frames instead of many small ones.
+	"""
+
+	def __init__(self, window: float = WS_BATCH_WINDOW) -> None:
+		self.window = window
+		self.pending: dict[str, list[SensorRow]] = {}
+		self.timer: asyncio.TimerHandle | None = None
+
+	def publish(
+		self, state: AppState, device_id: str, rows: Iterable[SensorRow]
+	) -> None:
+		if self.window <= 0:
+			broadcast_sensor_data(state, device_id, list(rows))
+			return
+
+		self.pending.setdefault(device_id, []).extend(rows)
+		if self.timer is None:
+			loop = asyncio.get_running_loop()
+			self.timer = loop.call_later(self.window, self.flush, state)
 
-	# Remove connections that failed
-	closed_connections = []
-	for connection, result in zip(state.ws_connections, results):
-		if isinstance(result, Exception):
-			print(f"Failed to send to WebSocket: {result}")
-			closed_connections.append(connection)
+	def flush(self, state: AppState) -> None:
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
 
-	# Remove closed connections
-	for connection in closed_connections:
-		state.ws_connections.discard(connection)
+		pending, self.pending = self.pending, {}
+		for device_id, rows in pending.items():
+			broadcast_sensor_data(state, device_id, rows)
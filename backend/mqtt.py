@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import ssl
+from collections.abc import Callable, Iterable
+from os import environ as env
+
+import aiomqtt
+from aiomqtt import Message, MqttError
+
+MQTT_HOST = env.get("MQTT_HOST", "localhost")
+MQTT_PORT = int(env.get("MQTT_PORT", "8883"))
+MQTT_USER = env.get("MQTT_USER", "")
+MQTT_PASS = env.get("MQTT_PASS", "")
+
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+PUBLISH_TIMEOUT = 5.0
+
+MessageHandler = Callable[[Message], None]
+
+
+class MqttTransport:
+	"""
+	MQTT connection running on the event loop. Keeps reconnecting with
+	exponential backoff, and restores the subscriptions after every reconnect.
+	"""
+
+	def __init__(self, on_message: MessageHandler, topics: Iterable[str] = ()) -> None:
+		self.on_message = on_message
+		self.topics = set(topics)
+		self.client: aiomqtt.Client | None = None
+		self.connected = asyncio.Event()
+		self.task: asyncio.Task[None] | None = None
+
+	def start(self) -> None:
+		self.task = asyncio.create_task(self.run())
+
+	async def stop(self) -> None:
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	async def run(self) -> None:
+		delay = RECONNECT_MIN_DELAY
+		while True:
+			try:
+				async with aiomqtt.Client(
+					MQTT_HOST,
+					MQTT_PORT,
+					username=MQTT_USER,
+					password=MQTT_PASS,
+					protocol=aiomqtt.ProtocolVersion.V5,
+					tls_context=ssl.create_default_context(),
+				) as client:
+					print(f"Connected to MQTT broker {MQTT_HOST}:{MQTT_PORT}")
+					for topic in self.topics:
+						await client.subscribe(topic)
+
+					self.client = client
+					self.connected.set()
+					delay = RECONNECT_MIN_DELAY
+
+					async for message in client.messages:
+						try:
+							self.on_message(message)
+						except Exception as e:
+							print(
+								f"Failed to handle MQTT message on {message.topic}: {e}"
+							)
+			except MqttError as e:
+				print(f"MQTT connection lost: {e}, reconnecting in {delay:.0f}s")
+			finally:
+				self.connected.clear()
+				self.client = None
+
+			await asyncio.sleep(delay)
+			delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+	async def subscribe(self, topic: str) -> None:
+		"""Subscribe now if connected, and on every future reconnect."""
+		self.topics.add(topic)
+		if self.client is not None:
+			await self.client.subscribe(topic)
+
+	async def publish(self, topic: str, payload: str | bytes | bool) -> None:
+		"""
+		Publish a message, waiting briefly for the connection to come back if
+		the broker is currently unreachable.
+		"""
+		try:
+			await asyncio.wait_for(self.connected.wait(), PUBLISH_TIMEOUT)
+		except TimeoutError:
+			raise MqttError(f"Not connected, could not publish to {topic}") from None
+
+		assert self.client is not None
+		await self.client.publish(topic, payload, timeout=PUBLISH_TIMEOUT)
@@ -0,0 +1,84 @@
+"""
+Request scoped database sessions. Every HTTP request (and WebSocket
+handshake) gets one session, opened on its first query and reused by auth and
+handler logic alike, which is committed before the response starts. Queries
+are counted and timed per request, and reported in a Server-Timing header.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from sqlalchemy import Engine, event
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+if TYPE_CHECKING:
+	from sqlalchemy.orm import Session
+
+	from backend.state import AppState
+
+
+@dataclass
+class RequestDb:
+	"""Database session and query statistics of one request"""
+
+	session: Session | None = None
+	# Set once the response started, later queries get their own session
+	closed: bool = False
+	lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+	queries: int = 0
+	duration: float = 0.0
+
+	def server_timing(self) -> str:
+		return f'db;dur={self.duration * 1000:.1f};desc="{self.queries} SQL"'
+
+
+current_request_db: ContextVar[RequestDb | None] = ContextVar(
+	"current_request_db", default=None
+)
+
+
+def install_query_stats(engine: Engine) -> None:
+	"""Count and time the queries of the current request on `engine`."""
+
+	@event.listens_for(engine, "before_cursor_execute")
+	def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+		conn.info["query_start"] = perf_counter()
+
+	@event.listens_for(engine, "after_cursor_execute")
+	def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+		request_db = current_request_db.get()
+		if request_db is not None:
+			request_db.queries += 1
+			request_db.duration += perf_counter() - conn.info.pop("query_start")
+
+
+class RequestDbMiddleware:
+	"""Opens a request scoped session for every HTTP request"""
+
+	def __init__(self, app: ASGIApp) -> None:
+		self.app = app
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+		if scope["type"] != "http":
+			await self.app(scope, receive, send)
+			return
+
+		state: AppState = scope["app"].state.data
+		async with state.db_scope() as request_db:
+
+			async def send_with_timing(message: Message) -> None:
+				if message["type"] == "http.response.start":
+					# Commit before the client can see the outcome of the request
+					await state.release_db()
+					headers = MutableHeaders(scope=message)
+					headers.append("Server-Timing", request_db.server_timing())
+				await send(message)
+
+			await self.app(scope, receive, send_with_timing)
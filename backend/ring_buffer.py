@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import numpy as np
+from numpy.typing import NDArray
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from backend.models import SensorData
+from backend.rollups import SensorBucket
+
+
+def to_timestamp(timestamp: datetime) -> float:
+	# Stored timestamps are naive, read them as UTC like SQLite's strftime('%s')
+	return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_timestamp(seconds: float) -> datetime:
+	return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+@dataclass
+class SensorWindow:
+	"""Columnar view over a run of readings, oldest first"""
+
+	ids: NDArray[np.int64]
+	timestamps: NDArray[np.float64]
+	temperature: NDArray[np.float64]
+	gas: NDArray[np.float64]
+
+	def __len__(self) -> int:
+		return len(self.ids)
+
+	@classmethod
+	def from_ids(cls, rows: list[tuple[int, float, float]]) -> SensorWindow:
+		"""
+		From (id, temperature, gas) rows: ids are epoch milliseconds, so this
+		skips building a datetime per row.
+		"""
+		ids = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+		return cls(
+			ids=ids,
+			timestamps=ids / 1000,
+			temperature=np.fromiter((row[1] for row in rows), np.float64, len(rows)),
+			gas=np.fromiter((row[2] for row in rows), np.float64, len(rows)),
+		)
+
+	def rows(self) -> list[tuple[int, datetime, float, float]]:
+		return [
+			(int(id), from_timestamp(float(timestamp)), float(temperature), float(gas))
+			for id, timestamp, temperature, gas in zip(
+				self.ids, self.timestamps, self.temperature, self.gas
+			)
+		]
+
+
+class SensorRingBuffer:
+	"""
+	Fixed capacity ring buffer of the newest committed readings, stored as
+	preallocated column arrays. Appending is O(1) without allocation, and
+	window queries return array views (or one copy per column when the window
+	wraps around the end of the buffer).
+
+	`horizon` is the oldest timestamp from which the buffer is known to hold
+	every reading, windows reaching further back can't be served from it.
+	"""
+
+	def __init__(self, capacity: int) -> None:
+		self.capacity = capacity
+		self.ids = np.zeros(capacity, np.int64)
+		self.timestamps = np.zeros(capacity, np.float64)
+		self.temperature = np.zeros(capacity, np.float64)
+		self.gas = np.zeros(capacity, np.float64)
+		self.head = 0  # next slot to write
+		self.size = 0
+		self.horizon = math.inf
+
+	def load(self, db: Session, device_id: str) -> None:
+		"""Seed the buffer with the device's newest rows in the database."""
+		rows = db.execute(
+			select(SensorData.id, SensorData.temperature, SensorData.gas)
+			.where(SensorData.device_id == device_id)
+			.order_by(SensorData.timestamp.desc())
+			.limit(self.capacity)
+		).all()
+		window = SensorWindow.from_ids(rows[::-1])
+
+		size = len(window)
+		self.ids[:size] = window.ids
+		self.timestamps[:size] = window.timestamps
+		self.temperature[:size] = window.temperature
+		self.gas[:size] = window.gas
+		self.head = size % self.capacity
+		self.size = size
+
+		self.horizon = -math.inf if size < self.capacity else self.oldest()
+
+	def append(
+		self, id: int, timestamp: datetime, temperature: float, gas: float
+	) -> None:
+		i = self.head
+		self.ids[i] = id
+		self.timestamps[i] = to_timestamp(timestamp)
+		self.temperature[i] = temperature
+		self.gas[i] = gas
+
+		self.head = (i + 1) % self.capacity
+		if self.size < self.capacity:
+			self.size += 1
+		else:
+			self.horizon = self.oldest()
+
+	def newest_id(self) -> int:
+		return int(self.ids[(self.head - 1) % self.capacity]) if self.size else 0
+
+	def oldest(self) -> float:
+		return float(self.timestamps[(self.head - self.size) % self.capacity])
+
+	def slice(self, start: int, stop: int) -> SensorWindow:
+		"""Readings from logical index `start` to `stop`, 0 being the oldest."""
+		first = (self.head - self.size + start) % self.capacity
+		last = first + (stop - start)
+		if last <= self.capacity:
+			return SensorWindow(
+				self.ids[first:last],
+				self.timestamps[first:last],
+				self.temperature[first:last],
+				self.gas[first:last],
+			)
+
+		last -= self.capacity
+		return SensorWindow(
+			np.concatenate((self.ids[first:], self.ids[:last])),
+			np.concatenate((self.timestamps[first:], self.timestamps[:last])),
+			np.concatenate((self.temperature[first:], self.temperature[:last])),
+			np.concatenate((self.gas[first:], self.gas[:last])),
+		)
+
+	def search(self, column: NDArray, value: float) -> int:
+		"""Logical index of the first reading with `column >= value`."""
+		split = (self.head - self.size) % self.capacity
+		if split + self.size <= self.capacity:
+			return int(np.searchsorted(column[split : split + self.size], value))
+
+		older = column[split:]
+		index = int(np.searchsorted(older, value))
+		if index < len(older):
+			return index
+		return len(older) + int(np.searchsorted(column[: self.head], value))
+
+	def since(self, cutoff: datetime) -> SensorWindow | None:
+		"""Readings at or after `cutoff`, None when the buffer can't tell."""
+		seconds = to_timestamp(cutoff)
+		if seconds < self.horizon:
+			return None
+		return self.slice(self.search(self.timestamps, seconds), self.size)
+
+	def after(self, id: int) -> SensorWindow | None:
+		"""Readings with an id above `id`, None when the buffer can't tell."""
+		if self.horizon != -math.inf and (
+			self.size == 0 or id < self.ids[(self.head - self.size) % self.capacity]
+		):
+			return None
+		return self.slice(self.search(self.ids, id + 1), self.size)
+
+	def latest(self, limit: int) -> SensorWindow | None:
+		"""The newest `limit` readings, None when the buffer can't tell."""
+		if limit > self.size and self.horizon != -math.inf:
+			return None
+		return self.slice(max(self.size - limit, 0), self.size)
+
+
+def aggregate(window: SensorWindow, resolution: int) -> list[SensorBucket]:
+	"""Group a window into buckets of `resolution` seconds, like query_buckets."""
+	if not len(window):
+		return []
+
+	buckets = (window.timestamps // resolution).astype(np.int64) * resolution
+	starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+	counts = np.diff(starts, append=len(buckets))
+
+	last_ids = np.maximum.reduceat(window.ids, starts)
+	temperature_min = np.minimum.reduceat(window.temperature, starts)
+	temperature_max = np.maximum.reduceat(window.temperature, starts)
+	temperature_avg = np.add.reduceat(window.temperature, starts) / counts
+	gas_min = np.minimum.reduceat(window.gas, starts)
+	gas_max = np.maximum.reduceat(window.gas, starts)
+	gas_avg = np.add.reduceat(window.gas, starts) / counts
+
+	return [
+		SensorBucket(
+			id=int(last_ids[i]),
+			timestamp=from_timestamp(float(buckets[start])),
+			count=int(counts[i]),
+			temperature_min=float(temperature_min[i]),
+			temperature_max=float(temperature_max[i]),
+			temperature_avg=float(temperature_avg[i]),
+			gas_min=float(gas_min[i]),
+			gas_max=float(gas_max[i]),
+			gas_avg=float(gas_avg[i]),
+		)
+		for i, start in enumerate(starts)
+	]
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import calendar
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Final
+
+from sqlalchemy import BigInteger, delete, func, insert, select, type_coerce
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from backend.models import (
+	SensorData,
+	SensorRollup,
+	SensorRollupDay,
+	SensorRollupHour,
+	SensorRollupMinute,
+)
+
+# Ordered from finest to coarsest
+ROLLUPS: Final[list[type[SensorRollup]]] = [
+	SensorRollupMinute,
+	SensorRollupHour,
+	SensorRollupDay,
+]
+
+
+@dataclass
+class SensorBucket:
+	"""Aggregated sensor readings over one time bucket"""
+
+	id: int
+	timestamp: datetime
+	count: int
+	temperature_min: float
+	temperature_max: float
+	temperature_avg: float
+	gas_min: float
+	gas_max: float
+	gas_avg: float
+
+
+def to_epoch(timestamp: datetime) -> int:
+	# Timestamps are naive UTC, like the stored epoch milliseconds
+	return calendar.timegm(timestamp.timetuple())
+
+
+def from_epoch(seconds: int) -> datetime:
+	return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+def raw_epoch():
+	"""Epoch seconds of raw readings, in SQL."""
+	return type_coerce(SensorData.timestamp, BigInteger) // 1000
+
+
+@dataclass
+class RollupRow:
+	count: int
+	last_id: int
+	temperature_sum: float
+	temperature_min: float
+	temperature_max: float
+	gas_sum: float
+	gas_min: float
+	gas_max: float
+
+
+def update_rollups(
+	db: Session, rows: Iterable[tuple[int, str, datetime, float, float]]
+) -> None:
+	"""
+	Fold freshly inserted (id, device_id, timestamp, temperature, gas) rows
+	into every rollup table, aggregating the batch in memory first so each
+	bucket costs one upsert.
+	"""
+	rows = list(rows)
+	if not rows:
+		return
+
+	for model in ROLLUPS:
+		buckets: dict[tuple[str, int], RollupRow] = {}
+		for id, device_id, timestamp, temperature, gas in rows:
+			bucket = to_epoch(timestamp) // model.resolution * model.resolution
+			agg = buckets.get((device_id, bucket))
+			if agg is None:
+				buckets[(device_id, bucket)] = RollupRow(
+					1, id, temperature, temperature, temperature, gas, gas, gas
+				)
+				continue
+
+			agg.count += 1
+			agg.last_id = max(agg.last_id, id)
+			agg.temperature_sum += temperature
+			agg.temperature_min = min(agg.temperature_min, temperature)
+			agg.temperature_max = max(agg.temperature_max, temperature)
+			agg.gas_sum += gas
+			agg.gas_min = min(agg.gas_min, gas)
+			agg.gas_max = max(agg.gas_max, gas)
+
+		stmt = sqlite_insert(model)
+		excluded = stmt.excluded
+		stmt = stmt.on_conflict_do_update(
+			index_elements=[model.device_id, model.bucket],
+			set_={
+				"count": model.count + excluded.count,
+				"last_id": func.max(model.last_id, excluded.last_id),
+				"temperature_sum": model.temperature_sum + excluded.temperature_sum,
+				"temperature_min": func.min(
+					model.temperature_min, excluded.temperature_min
+				),
+				"temperature_max": func.max(
+					model.temperature_max, excluded.temperature_max
+				),
+				"gas_sum": model.gas_sum + excluded.gas_sum,
+				"gas_min": func.min(model.gas_min, excluded.gas_min),
+				"gas_max": func.max(model.gas_max, excluded.gas_max),
+			},
+		)
+
+		db.execute(
+			stmt,
+			[
+				{"device_id": device_id, "bucket": bucket, **vars(agg)}
+				for (device_id, bucket), agg in buckets.items()
+			],
+		)
+
+
+def backfill_rollups(db: Session) -> None:
+	"""Rebuild every rollup table from the raw sensor_data table."""
+	for model in ROLLUPS:
+		bucket = raw_epoch() // model.resolution * model.resolution
+		db.execute(delete(model))
+		db.execute(
+			insert(model).from_select(
+				[
+					"device_id",
+					"bucket",
+					"count",
+					"last_id",
+					"temperature_sum",
+					"temperature_min",
+					"temperature_max",
+					"gas_sum",
+					"gas_min",
+					"gas_max",
+				],
+				select(
+					SensorData.device_id,
+					bucket,
+					func.count(),
+					func.max(SensorData.id),
+					func.sum(SensorData.temperature),
+					func.min(SensorData.temperature),
+					func.max(SensorData.temperature),
+					func.sum(SensorData.gas),
+					func.min(SensorData.gas),
+					func.max(SensorData.gas),
+				).group_by(SensorData.device_id, bucket),
+			)
+		)
+
+
+def pick_rollup(resolution: int) -> type[SensorRollup] | None:
+	"""The coarsest rollup whose buckets evenly divide the requested ones."""
+	for model in reversed(ROLLUPS):
+		if resolution % model.resolution == 0:
+			return model
+	return None
+
+
+def query_buckets(
+	db: Session, device_id: str, since: datetime, resolution: int
+) -> list[SensorBucket]:
+	"""
+	Aggregate a device's readings since `since` into buckets of `resolution`
+	seconds, reading from a rollup table when one fits and from raw rows
+	otherwise. Both are range scans over a (device_id, time) index.
+	"""
+	model = pick_rollup(resolution)
+	if model is None:
+		bucket = (raw_epoch() // resolution * resolution).label("bucket")
+		query = (
+			select(
+				bucket,
+				func.max(SensorData.id),
+				func.count(),
+				func.min(SensorData.temperature),
+				func.max(SensorData.temperature),
+				func.avg(SensorData.temperature),
+				func.min(SensorData.gas),
+				func.max(SensorData.gas),
+				func.avg(SensorData.gas),
+			)
+			.where(SensorData.device_id == device_id, SensorData.timestamp >= since)
+			.group_by(bucket)
+			.order_by(bucket)
+		)
+	else:
+		bucket = (model.bucket // resolution * resolution).label("bucket")
+		total = func.sum(model.count)
+		query = (
+			select(
+				bucket,
+				func.max(model.last_id),
+				total,
+				func.min(model.temperature_min),
+				func.max(model.temperature_max),
+				func.sum(model.temperature_sum) / total,
+				func.min(model.gas_min),
+				func.max(model.gas_max),
+				func.sum(model.gas_sum) / total,
+			)
+			.where(
+				model.device_id == device_id,
+				model.bucket >= to_epoch(since) // model.resolution * model.resolution,
+			)
+			.group_by(bucket)
+			.order_by(bucket)
+		)
+
+	return [
+		SensorBucket(
+			id=id,
+			timestamp=from_epoch(start),
+			count=count,
+			temperature_min=temperature_min,
+			temperature_max=temperature_max,
+			temperature_avg=temperature_avg,
+			gas_min=gas_min,
+			gas_max=gas_max,
+			gas_avg=gas_avg,
+		)
+		for (
+			start,
+			id,
+			count,
+			temperature_min,
+			temperature_max,
+			temperature_avg,
+			gas_min,
+			gas_max,
+			gas_avg,
+		) in db.execute(query)
+	]
@@ -1,86 +1,118 @@
 from __future__ import annotations
 
 import asyncio
+import contextvars
 import json
-import ssl
-from collections.abc import Awaitable, Callable, Generator
-from contextlib import contextmanager
+from collections.abc import AsyncGenerator, Awaitable, Callable, Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from dataclasses import dataclass
-from datetime import datetime
-from os import environ as env
-from typing import cast
-
-import paho.mqtt.client as paho
-from openai import OpenAI
-from paho.mqtt.client import Client
-from sqlalchemy import Engine, create_engine
+from typing import TypeVar
+
+from aiomqtt import Message, MqttError
+from openai import AsyncOpenAI
+from sqlalchemy import Engine
 from sqlalchemy.orm import Session, sessionmaker
 from starlette.applications import Starlette
 from starlette.requests import HTTPConnection
-from starlette.websockets import WebSocket
-
-from backend.models import Base, SensorData
-from backend.modules.websocket.websocket_service import broadcast_sensor_data
-
-MQTT_HOST = env.get("MQTT_HOST", "localhost")
-MQTT_PORT = int(env.get("MQTT_PORT", 8883))
-MQTT_USER = env.get("MQTT_USER", "")
-MQTT_PASS = env.get("MQTT_PASS", "")
-
-
-def init_mqtt(client: Client) -> Client:
-	def on_connect(client, userdata, flags, rc, properties=None) -> None:
-		print("CONNACK received with code %s." % rc)
 
-	client.on_connect = on_connect
-
-	def on_publish(client, userdata, mid, properties=None) -> None:
-		print("mid: " + str(mid))
-
-	client.on_publish = on_publish
-
-	def on_message(client, userdata, msg) -> None:
-		payload_str = msg.payload.decode()
-		data = json.loads(payload_str)
-		temperature = data["temperature"]
-		gas = data["gas"]
-		if temperature is not None and gas is not None:
-			print(f"Temperature: {temperature}, Gas: {gas}")
-			timestamp = datetime.now()
-			with userdata.get_db() as db:
-				sensor_data = SensorData(
-					timestamp=timestamp, temperature=temperature, gas=gas
-				)
-				db.add(sensor_data)
-				db.commit()
-
-			# Broadcast to WebSocket clients
-			loop = userdata.main_loop
-			asyncio.run_coroutine_threadsafe(
-				broadcast_sensor_data(
-					userdata,
-					{
-						"id": cast(int, sensor_data.id),
-						"timestamp": timestamp.isoformat(),
-						"temperature": temperature,
-						"gas": gas,
-					},
-				),
-				loop,
-			)
-
-	client.on_message = on_message
-
-	client.tls_set(tls_version=ssl.PROTOCOL_TLS)
-
-	client.username_pw_set(MQTT_USER, MQTT_PASS)
-	client.connect(MQTT_HOST, MQTT_PORT)
-
-	client.subscribe("sensor/response")
-
-	client.loop_start()
-
-	return client
+from backend.broker import Broker, create_broker
+from backend.devices import (
+	MAX_DEVICES,
+	SENSOR_TOPICS,
+	Device,
+	device_from_topic,
+	known_device_ids,
+)
+from backend.migrate import is_current, migrate, migration_lock
+from backend.models import utc_now
+from backend.modules.websocket.websocket_service import (
+	SensorBroadcaster,
+	WebSocketClient,
+	broadcast_message,
+)
+from backend.mqtt import MqttTransport
+from backend.request_db import RequestDb, current_request_db, install_query_stats
+from backend.storage import (
+	DB_WORKERS,
+	SPOOL_DATABASE_URL,
+	create_db_engines,
+	create_remote_engine,
+	is_local,
+	session_binds,
+)
+from backend.tasks.detect_hazards import ALERTS_TOPIC, handle_alerts
+from backend.tasks.forward_sensors import SensorForwarder, bootstrap_spool
+from backend.tasks.ingest_sensors import (
+	READINGS_TOPIC,
+	SensorIngest,
+	SensorReading,
+	decode_rows,
+)
+from backend.tasks.poll_sensors import (
+	POLL_CONTROL_TOPIC,
+	POLL_STATUS_TOPIC,
+	PollScheduler,
+)
+from backend.tasks.retention import RETENTION_INTERVAL, enforce_retention
+
+T = TypeVar("T")
+
+# MQTT subscriptions in flight, referenced until they complete
+pending_subscriptions: set[asyncio.Task[None]] = set()
+
+
+def handle_sensor_message(state: AppState, message: Message) -> None:
+	device_id = device_from_topic(str(message.topic))
+	if device_id is None:
+		print(f"Ignoring readings on invalid topic {message.topic}")
+		return
+
+	data = json.loads(message.payload)
+	temperature = data["temperature"]
+	gas = data["gas"]
+	if temperature is None or gas is None:
+		return
+
+	device = state.admit_device(device_id)
+	if device is None:
+		print(f"Ignoring readings of {device_id}, {MAX_DEVICES} devices tracked")
+		return
+
+	reading = SensorReading(
+		device_id=device_id,
+		timestamp=device.stamp(utc_now()),
+		temperature=temperature,
+		gas=gas,
+	)
+
+	# Detect before queueing, so alerts don't wait for the batch to commit
+	alerts = device.detector.observe(reading.timestamp, temperature, gas)
+	if alerts:
+		handle_alerts(state, device_id, alerts)
+
+	state.ingest.submit(reading)
+
+
+def handle_committed_readings(state: AppState, payload: bytes) -> None:
+	for device_id, device_rows in decode_rows(payload).items():
+		device = state.device(device_id)
+
+		# Skip rows the buffer already loaded from the database at startup
+		newest = device.buffer.newest_id()
+		rows = [row for row in device_rows if row[0] > newest]
+
+		for row in rows:
+			device.buffer.append(*row)
+		device.forecaster.update(rows)
+		state.broadcaster.publish(state, device_id, rows)
+
+
+async def subscribe_sensors(state: AppState) -> None:
+	try:
+		await asyncio.gather(*(state.mqtt.subscribe(topic) for topic in SENSOR_TOPICS))
+	except MqttError as e:
+		print(f"Failed to subscribe to sensor readings: {e}")
 
 
 def start_task(
@@ -96,54 +128,165 @@ def start_task(
 
 @dataclass
 class AppState:
+	# Every query runs on one of the database threads, so the event loop never
+	# waits on the database. Writes go through their own single thread.
 	db_engine: Engine
+	read_engine: Engine
+	# Set when db_engine is the spool of a remote database
+	remote_engine: Engine | None
 	session: sessionmaker[Session]
-	openai_client: OpenAI
+	write_session: sessionmaker[Session]
+	db_executor: ThreadPoolExecutor
+	write_executor: ThreadPoolExecutor
+	openai_client: AsyncOpenAI
+
+	ws_connections: set[WebSocketClient]
+	broadcaster: SensorBroadcaster
 
-	ws_connections: set[WebSocket]
+	mqtt: MqttTransport
+	broker: Broker
 
-	mqtt_client: Client
+	ingest: SensorIngest
+	forwarder: SensorForwarder
+	devices: dict[str, Device]
+	poller: PollScheduler
 
 	main_loop: asyncio.AbstractEventLoop
 
-	sensor_task: asyncio.Task[None] | None = None
+	retention_task: asyncio.Task[None] | None = None
 
 	@classmethod
 	def init(cls, app: Starlette) -> AppState:
-		turso_url = env.get("TURSO_DATABASE_URL")
-		if turso_url is None:
-			engine = create_engine("sqlite+libsql:///data.db")
-		else:
-			engine = create_engine(
-				f"sqlite+{turso_url}?secure=true",
-				connect_args={
-					"auth_token": env.get("TURSO_AUTH_TOKEN"),
-				},
+		remote_engine = create_remote_engine()
+		engine, read_engine = create_db_engines(
+			SPOOL_DATABASE_URL if remote_engine is not None else None
+		)
+		if remote_engine is not None and not is_current(remote_engine):
+			raise RuntimeError(
+				"The remote database schema is out of date, "
+				"migrate it with `python -m backend.migrate` first"
 			)
 
-		Base.metadata.create_all(bind=engine)
+		# Workers starting together take turns, the first one migrates
+		with migration_lock():
+			if is_local(engine):
+				# Only takes effect for new database files, existing ones can be
+				# converted with `python -m backend.tasks.retention --vacuum`
+				with engine.connect() as conn:
+					conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+			migrate(engine)
+			if remote_engine is not None:
+				bootstrap_spool(engine, remote_engine)
+
+		install_query_stats(engine)
+		if read_engine is not engine:
+			install_query_stats(read_engine)
+		if remote_engine is not None:
+			install_query_stats(remote_engine)
 
 		main_loop = asyncio.get_event_loop()
 
 		state = cls(
 			db_engine=engine,
+			read_engine=read_engine,
+			remote_engine=remote_engine,
 			session=sessionmaker(
-				autocommit=False, autoflush=False, bind=engine, expire_on_commit=False
+				autocommit=False,
+				autoflush=False,
+				bind=read_engine,
+				binds=session_binds(read_engine, remote_engine),
+				expire_on_commit=False,
+			),
+			write_session=sessionmaker(
+				autocommit=False,
+				autoflush=False,
+				bind=engine,
+				binds=session_binds(engine, remote_engine),
+				expire_on_commit=False,
 			),
-			openai_client=OpenAI(),
+			db_executor=ThreadPoolExecutor(DB_WORKERS, thread_name_prefix="db"),
+			write_executor=ThreadPoolExecutor(1, thread_name_prefix="db-write"),
+			openai_client=AsyncOpenAI(),
 			ws_connections=set(),
-			mqtt_client=init_mqtt(paho.Client(client_id="", protocol=paho.MQTTv5)),
+			broadcaster=SensorBroadcaster(),
+			mqtt=MqttTransport(lambda message: handle_sensor_message(state, message)),
+			broker=create_broker(),
+			ingest=SensorIngest(),
+			forwarder=SensorForwarder(),
+			devices={},
+			poller=PollScheduler(),
 			main_loop=main_loop,
 		)
-		state.mqtt_client.user_data_set(state)
+		with state.get_db() as db:
+			for device_id in known_device_ids(db):
+				state.devices[device_id] = Device.load(db, device_id)
+
+		state.broker.subscribe(
+			READINGS_TOPIC, lambda payload: handle_committed_readings(state, payload)
+		)
+		state.broker.subscribe(
+			ALERTS_TOPIC, lambda payload: broadcast_message(state, payload.decode())
+		)
+		state.broker.subscribe(
+			POLL_CONTROL_TOPIC,
+			lambda payload: state.poller.handle_control(state, payload),
+		)
+		state.broker.subscribe(POLL_STATUS_TOPIC, state.poller.handle_status)
+		state.broker.start(state.start_ingest)
+
+		# Every worker publishes device commands, only the leader ingests
+		state.mqtt.start()
 
 		app.state.data = state
 
 		return state
 
+	def start_ingest(self) -> None:
+		"""
+		Start the work only the leader worker does: ingestion, forwarding,
+		retention, and polling if the previous leader was polling
+		"""
+		self.ingest.start(self)
+		if self.poller.status.running:
+			self.poller.start(self)
+			self.poller.publish_status(self)
+		if self.remote_engine is not None:
+			self.forwarder.start(self)
+		self.retention_task = start_task(
+			lambda: enforce_retention(self), interval=RETENTION_INTERVAL
+		)
+		task = asyncio.create_task(subscribe_sensors(self))
+		pending_subscriptions.add(task)
+		task.add_done_callback(pending_subscriptions.discard)
+
+	def admit_device(self, device_id: str) -> Device | None:
+		"""
+		State of a device reporting readings, None for a new device once
+		MAX_DEVICES are tracked.
+		"""
+		if device_id not in self.devices and len(self.devices) >= MAX_DEVICES:
+			return None
+		return self.device(device_id)
+
+	def device(self, device_id: str) -> Device:
+		"""State of a device, created empty the first time it reports."""
+		device = self.devices.get(device_id)
+		if device is None:
+			print(f"New sensor device {device_id}")
+			device = self.devices[device_id] = Device.create(device_id)
+		return device
+
 	async def deinit(self) -> None:
-		if self.sensor_task is not None:
-			self.sensor_task.cancel()
+		await self.poller.stop()
+
+		if self.retention_task is not None:
+			self.retention_task.cancel()
+
+		await self.mqtt.stop()
+		await self.ingest.stop(self)
+		await self.forwarder.stop()
+		await self.broker.stop()
+		self.broadcaster.flush(self)
 
 		if self.ws_connections:
 			await asyncio.gather(
@@ -153,11 +296,18 @@ class AppState:
 				)
 			)
 
+		await self.openai_client.close()
+		self.db_executor.shutdown()
+		self.write_executor.shutdown()
 		self.db_engine.dispose()
+		if self.read_engine is not self.db_engine:
+			self.read_engine.dispose()
+		if self.remote_engine is not None:
+			self.remote_engine.dispose()
 
 	@contextmanager
-	def get_db(self) -> Generator[Session]:
-		db = self.session()
+	def get_db(self, write: bool = False) -> Generator[Session]:
+		db = (self.write_session if write else self.session)()
 		try:
 			yield db
 			db.commit()
@@ -167,6 +317,100 @@ class AppState:
 		finally:
 			db.close()
 
+	async def run_sync(
+		self, fn: Callable[..., T], *args: object, write: bool = False
+	) -> T:
+		"""Run blocking database work on the database threads, or the writer's."""
+		loop = asyncio.get_running_loop()
+		executor = self.write_executor if write else self.db_executor
+		# Carry the request context over, so its queries are counted
+		context = contextvars.copy_context()
+		return await loop.run_in_executor(executor, context.run, fn, *args)
+
+	async def run_write(self, fn: Callable[[Session], T]) -> T:
+		"""
+		Run `fn` in a session of its own on the writer thread, committed right
+		after it. Writes are never part of the request's session, which would
+		hold the writer's connection until the response.
+		"""
+
+		def run() -> T:
+			with self.get_db(write=True) as db:
+				return fn(db)
+
+		return await self.run_sync(run, write=True)
+
+	async def run_db(self, fn: Callable[[Session], T]) -> T:
+		"""
+		Run read queries in `fn` on the database threads. Within a request it
+		shares the request's session, committed when the request completes,
+		otherwise it gets a session of its own committed right after it.
+		"""
+		request_db = current_request_db.get()
+		if request_db is None or request_db.closed:
+
+			def run() -> T:
+				with self.get_db() as db:
+					return fn(db)
+
+			return await self.run_sync(run)
+
+		# Sessions aren't thread safe, concurrent calls take turns
+		async with request_db.lock:
+			if request_db.session is None:
+				request_db.session = self.session()
+			db = request_db.session
+
+			def run_shared() -> T:
+				try:
+					return fn(db)
+				except Exception:
+					db.rollback()
+					raise
+
+			return await self.run_sync(run_shared)
+
+	@asynccontextmanager
+	async def db_scope(self) -> AsyncGenerator[RequestDb]:
+		"""Share one session between the database calls of a request."""
+		request_db = RequestDb()
+		token = current_request_db.set(request_db)
+		try:
+			yield request_db
+		except BaseException:
+			await self.release_db(commit=False)
+			raise
+		else:
+			await self.release_db()
+		finally:
+			current_request_db.reset(token)
+
+	async def release_db(self, commit: bool = True) -> None:
+		"""
+		End the request's transaction and return its connection to the pool,
+		queries made after this get sessions of their own.
+		"""
+		request_db = current_request_db.get()
+		if request_db is None:
+			return
+
+		async with request_db.lock:
+			request_db.closed = True
+			db, request_db.session = request_db.session, None
+			if db is None:
+				return
+
+			def close() -> None:
+				try:
+					if commit:
+						db.commit()
+					else:
+						db.rollback()
+				finally:
+					db.close()
+
+			await self.run_sync(close)
+
 	@staticmethod
 	def get(request: HTTPConnection) -> AppState:
 		return request.app.state.data
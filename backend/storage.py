@@ -0,0 +1,143 @@
+"""
+Database engines, and the storage profile of a local SQLite database.
+
+DB_PROFILE=wal, the default, switches to write-ahead logging so readers never
+wait for the writer: reads go through a pool of query_only connections, and
+writes through a single connection used by a single thread, serializing them
+in the app rather than on the lock. DB_PROFILE=default keeps SQLite's
+defaults, with readers and the writer sharing one connection pool and
+contending for the database lock. It has no busy timeout, as libsql holds the
+GIL while waiting for the lock, which stalls the threads holding it. Remote
+(Turso) databases ignore the profile.
+
+With a remote database the app still stores sensor data in a local SQLite
+spool, and a forwarder ships it to the remote database in the background
+(see backend.tasks.forward_sensors). Sessions route the sensor tables to the
+spool and every other table to the remote database.
+"""
+
+from os import environ as env
+
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.exc import OperationalError
+
+from backend.models import Base, SensorData, SpoolCursor
+from backend.rollups import ROLLUPS
+
+DB_PROFILE = env.get("DB_PROFILE", "wal")
+PROFILES = ["default", "wal"]
+
+# Threads running read queries, and connections in the readers' pool
+DB_WORKERS = int(env.get("DB_WORKERS", "4"))
+
+LOCAL_DATABASE_URL = "sqlite+libsql:///data.db"
+
+# Local database sensor data is committed to first when the database is remote
+SPOOL_DATABASE_URL = env.get("SPOOL_DATABASE_URL", LOCAL_DATABASE_URL)
+
+# Tables kept in the spool
+SPOOLED_MODELS: list[type[Base]] = [SensorData, *ROLLUPS, SpoolCursor]
+
+# Pragmas of the wal profile, the cache is in KiB when negative
+SQLITE_SYNCHRONOUS = env.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE = int(env.get("SQLITE_CACHE_SIZE", "-65536"))
+SQLITE_MMAP_SIZE = int(env.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT = int(env.get("SQLITE_BUSY_TIMEOUT", "5000"))
+
+
+def is_local(engine: Engine) -> bool:
+	return engine.url.host is None
+
+
+def is_locked(error: Exception) -> bool:
+	"""
+	Whether a write failed on the database lock, and may succeed when retried.
+	libsql raises ValueError where sqlite3 raises OperationalError.
+	"""
+	message = str(error)
+	return isinstance(error, OperationalError | ValueError) and (
+		"database is locked" in message or "database is busy" in message
+	)
+
+
+def apply_profile(engine: Engine, read_only: bool) -> None:
+	"""Set the wal profile's pragmas on every new connection of `engine`."""
+	pragmas = [
+		f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}",
+		f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}",
+		f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}",
+		f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}",
+	]
+	if read_only:
+		pragmas.append("PRAGMA query_only = ON")
+	else:
+		# Persistent, but cheap to repeat
+		pragmas.insert(0, "PRAGMA journal_mode = WAL")
+
+	@event.listens_for(engine, "connect")
+	def set_pragmas(dbapi_connection, connection_record) -> None:
+		cursor = dbapi_connection.cursor()
+		try:
+			for pragma in pragmas:
+				cursor.execute(pragma)
+		finally:
+			cursor.close()
+
+
+def create_db_engine(
+	url: str | None = None,
+	profile: str = DB_PROFILE,
+	pool_size: int = 5,
+	read_only: bool = False,
+) -> Engine:
+	"""Engine of the configured database, or of the local database at `url`."""
+	turso_url = env.get("TURSO_DATABASE_URL")
+	if url is None and turso_url is not None:
+		return create_engine(
+			f"sqlite+{turso_url}?secure=true",
+			connect_args={
+				"auth_token": env.get("TURSO_AUTH_TOKEN"),
+			},
+			pool_size=pool_size,
+		)
+
+	engine = create_engine(url or LOCAL_DATABASE_URL, pool_size=pool_size)
+	if profile == "wal":
+		apply_profile(engine, read_only)
+	return engine
+
+
+def create_remote_engine() -> Engine | None:
+	"""Engine of the remote database, None when the database is local."""
+	if env.get("TURSO_DATABASE_URL") is None:
+		return None
+	return create_db_engine(pool_size=DB_WORKERS)
+
+
+def session_binds(local: Engine, remote: Engine | None) -> dict[type[Base], Engine]:
+	"""
+	Per table engines of sessions bound to `local`: the remote database, if
+	any, for everything but the spooled tables.
+	"""
+	if remote is None:
+		return {}
+	return {Base: remote, **dict.fromkeys(SPOOLED_MODELS, local)}
+
+
+def create_db_engines(
+	url: str | None = None, profile: str = DB_PROFILE
+) -> tuple[Engine, Engine]:
+	"""
+	(writer, reader) engines. With the wal profile the writer holds a single
+	connection and the reader DB_WORKERS read only ones, otherwise both are
+	the same engine.
+	"""
+	local = url is not None or env.get("TURSO_DATABASE_URL") is None
+	if profile == "wal" and local:
+		return (
+			create_db_engine(url, profile, pool_size=1),
+			create_db_engine(url, profile, pool_size=DB_WORKERS, read_only=True),
+		)
+
+	engine = create_db_engine(url, profile, pool_size=DB_WORKERS + 1)
+	return engine, engine
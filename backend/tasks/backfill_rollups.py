@@ -0,0 +1,30 @@
+"""
+Rebuild the rollup tables from the raw sensor data, for databases created
+before rollups were maintained at ingest time.
+
+Usage: python -m backend.tasks.backfill_rollups
+"""
+
+from sqlalchemy.orm import Session
+
+from backend.models import Base
+from backend.rollups import ROLLUPS, backfill_rollups
+from backend.storage import create_db_engine
+
+
+def main() -> None:
+	engine = create_db_engine()
+	Base.metadata.create_all(bind=engine)
+
+	with Session(engine) as db:
+		backfill_rollups(db)
+		db.commit()
+
+		for model in ROLLUPS:
+			print(f"{model.__tablename__}: {db.query(model).count()} buckets")
+
+	engine.dispose()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,188 @@
+"""
+Measure the compact sensor_data layout against the legacy one.
+
+Usage: python -m backend.tasks.bench_schema [--database FILE] [--rows N] [--devices N] [--scans N]
+
+The legacy table is a copy of --database, or a synthetic one with --rows
+readings spread over --devices boards at one second intervals. It is
+converted with backend.migrate, and both layouts report the bytes per row of
+sensor_data and its indexes, and the speed of per-device range scans, with
+the stored values as they are and with timestamps read as datetimes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import Engine, create_engine
+
+from backend.migrate import migrate
+from backend.models import from_millis, to_millis, utc_now
+
+# The rowid layout from before the compact one, as created by SQLAlchemy
+LEGACY_SCHEMA = """
+CREATE TABLE sensor_data (
+	id INTEGER NOT NULL PRIMARY KEY,
+	device_id VARCHAR(64) DEFAULT 'default' NOT NULL,
+	timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP) NOT NULL,
+	temperature FLOAT NOT NULL,
+	gas FLOAT NOT NULL
+);
+CREATE INDEX ix_sensor_data_id ON sensor_data (id);
+CREATE INDEX ix_sensor_data_timestamp ON sensor_data (timestamp);
+CREATE INDEX ix_sensor_data_device_timestamp ON sensor_data (device_id, timestamp);
+"""
+
+# History read by every range scan
+SCAN_WINDOW = timedelta(hours=1)
+
+
+def seed_legacy(engine: Engine, rows: int, devices: int) -> None:
+	conn = engine.raw_connection()
+	try:
+		conn.cursor().executescript(LEGACY_SCHEMA)
+		conn.commit()
+	finally:
+		conn.close()
+
+	start = utc_now() - timedelta(seconds=rows // devices)
+	with engine.begin() as conn:
+		conn.exec_driver_sql(
+			"INSERT INTO sensor_data (device_id, timestamp, temperature, gas) "
+			"VALUES (?, ?, ?, ?)",
+			[
+				(
+					f"board-{i % devices}",
+					str(start + timedelta(seconds=i // devices, microseconds=i % 997)),
+					random.uniform(18, 30),
+					random.uniform(80, 200),
+				)
+				for i in range(rows)
+			],
+		)
+
+
+def table_bytes(engine: Engine) -> tuple[int, int, int]:
+	"""Bytes, B-trees and rows of sensor_data including its indexes."""
+	with engine.connect() as conn:
+		size, trees = conn.exec_driver_sql(
+			"SELECT sum(pgsize), count(DISTINCT name) FROM dbstat WHERE name IN "
+			"(SELECT name FROM sqlite_schema WHERE tbl_name = 'sensor_data')"
+		).one()
+		rows = conn.exec_driver_sql("SELECT count(*) FROM sensor_data").scalar()
+	return size, trees, rows
+
+
+def range_scans(
+	engine: Engine,
+	scans: int,
+	to_param: Callable[[datetime], object],
+	parse: Callable[[object], datetime],
+	convert: bool,
+) -> tuple[list[float], int]:
+	"""
+	Seconds per scan over SCAN_WINDOW of a random device, and rows read.
+	With `convert`, every timestamp read is parsed into a datetime.
+	"""
+	with engine.connect() as conn:
+		devices = list(
+			conn.exec_driver_sql("SELECT DISTINCT device_id FROM sensor_data").scalars()
+		)
+		first, last = (
+			parse(value)
+			for value in conn.exec_driver_sql(
+				"SELECT min(timestamp), max(timestamp) FROM sensor_data"
+			).one()
+		)
+
+		seconds: list[float] = []
+		total = 0
+		span = max((last - first - SCAN_WINDOW).total_seconds(), 0)
+		for _ in range(scans):
+			since = first + timedelta(seconds=random.uniform(0, span))
+			start = time.perf_counter()
+			rows = conn.exec_driver_sql(
+				"SELECT timestamp, temperature, gas FROM sensor_data "
+				"WHERE device_id = ? AND timestamp >= ? AND timestamp < ? "
+				"ORDER BY timestamp",
+				(
+					random.choice(devices),
+					to_param(since),
+					to_param(since + SCAN_WINDOW),
+				),
+			).all()
+			if convert:
+				rows = [
+					(parse(timestamp), temperature, gas)
+					for timestamp, temperature, gas in rows
+				]
+			seconds.append(time.perf_counter() - start)
+			total += len(rows)
+	return seconds, total
+
+
+def report(
+	name: str,
+	engine: Engine,
+	scans: int,
+	to_param: Callable[[datetime], object],
+	parse: Callable[[object], datetime],
+) -> None:
+	size, trees, rows = table_bytes(engine)
+	print(f"\n{name}: {rows} rows in {trees} B-trees, {size / 1024:.0f} KiB")
+	print(f"  {size / max(rows, 1):.1f} bytes per row")
+
+	for label, convert in (("stored values", False), ("datetimes", True)):
+		seconds, total = range_scans(engine, scans, to_param, parse, convert)
+		millis = np.array(seconds) * 1000
+		print(
+			f"  {len(millis)} range scans of {SCAN_WINDOW} as {label}: "
+			f"p50 {np.percentile(millis, 50):.2f}ms, "
+			f"p99 {np.percentile(millis, 99):.2f}ms, "
+			f"{total / max(sum(seconds), 1e-9):.0f} rows/s"
+		)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--database", help="legacy database file to measure")
+	parser.add_argument("--rows", type=int, default=500_000, help="synthetic rows")
+	parser.add_argument("--devices", type=int, default=4, help="synthetic boards")
+	parser.add_argument("--scans", type=int, default=200, help="range scans")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		legacy_path = Path(directory) / "legacy.db"
+		compact_path = Path(directory) / "compact.db"
+
+		legacy = create_engine(f"sqlite+libsql:///{legacy_path}")
+		if args.database:
+			shutil.copyfile(args.database, legacy_path)
+		else:
+			seed_legacy(legacy, args.rows, args.devices)
+		with legacy.connect() as conn:
+			conn.exec_driver_sql("VACUUM")
+
+		report("legacy", legacy, args.scans, str, datetime.fromisoformat)
+		legacy.dispose()
+
+		shutil.copyfile(legacy_path, compact_path)
+		compact = create_engine(f"sqlite+libsql:///{compact_path}")
+		start = time.perf_counter()
+		migrate(compact)
+		print(f"\nMigrated in {time.perf_counter() - start:.1f}s")
+
+		report("compact", compact, args.scans, to_millis, from_millis)
+		compact.dispose()
+
+
+if __name__ == "__main__":
+	main()
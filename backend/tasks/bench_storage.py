@@ -0,0 +1,172 @@
+"""
+Benchmark the storage profiles under concurrent ingest and query load.
+
+Usage: python -m backend.tasks.bench_storage [--profile NAME] [--seconds N] [--readers N] [--rows N] [--batch N]
+
+Each profile gets a fresh database file, seeded with --rows readings. One
+thread then commits ingest batches at the ingester's flush interval while
+--readers threads run dashboard queries against it, like the app's writer
+and database threads do.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+
+from backend.migrate import migrate
+from backend.models import DEFAULT_DEVICE, utc_now
+from backend.rollups import query_buckets
+from backend.storage import PROFILES, create_db_engines
+from backend.tasks.ingest_sensors import (
+	INGEST_BATCH_SIZE,
+	INGEST_FLUSH_INTERVAL,
+	SensorReading,
+	write_batch,
+)
+
+# Dashboard queries the readers pick from: (history, bucket seconds), the
+# first served by the minute rollup and the second from raw rows
+QUERIES = [(timedelta(days=1), 60), (timedelta(hours=1), 10)]
+
+
+@dataclass
+class Latencies:
+	seconds: list[float] = field(default_factory=list)
+	errors: int = 0
+
+	def report(self, name: str, elapsed: float) -> str:
+		if not self.seconds:
+			return f"{name}: no successful operations, {self.errors} errors"
+		millis = np.array(self.seconds) * 1000
+		return (
+			f"{name}: {len(millis) / elapsed:.1f}/s, "
+			f"p50 {np.percentile(millis, 50):.2f}ms, "
+			f"p99 {np.percentile(millis, 99):.2f}ms, "
+			f"max {millis.max():.2f}ms, "
+			f"{self.errors} errors"
+		)
+
+
+def readings(start: datetime, count: int, step: timedelta) -> list[SensorReading]:
+	return [
+		SensorReading(
+			device_id=DEFAULT_DEVICE,
+			timestamp=start + step * i,
+			temperature=random.uniform(18, 30),
+			gas=random.uniform(80, 200),
+		)
+		for i in range(count)
+	]
+
+
+def seed(engine: Engine, rows: int) -> None:
+	"""Spread `rows` readings over the last day."""
+	step = timedelta(days=1) / max(rows, 1)
+	start = utc_now() - timedelta(days=1)
+	for offset in range(0, rows, INGEST_BATCH_SIZE):
+		count = min(INGEST_BATCH_SIZE, rows - offset)
+		with Session(engine) as db, db.begin():
+			write_batch(db, readings(start + step * offset, count, step))
+
+
+def write_load(engine: Engine, stop: threading.Event, batch: int) -> Latencies:
+	latencies = Latencies()
+	while not stop.is_set():
+		start = time.perf_counter()
+		try:
+			with Session(engine) as db, db.begin():
+				write_batch(db, readings(utc_now(), batch, timedelta(milliseconds=1)))
+		except Exception:
+			# Mostly "database is locked" from contending with the readers
+			latencies.errors += 1
+		else:
+			latencies.seconds.append(time.perf_counter() - start)
+		stop.wait(INGEST_FLUSH_INTERVAL)
+	return latencies
+
+
+def read_load(engine: Engine, stop: threading.Event) -> Latencies:
+	latencies = Latencies()
+	while not stop.is_set():
+		history, resolution = random.choice(QUERIES)
+		start = time.perf_counter()
+		try:
+			with Session(engine) as db:
+				query_buckets(db, DEFAULT_DEVICE, utc_now() - history, resolution)
+		except Exception:
+			latencies.errors += 1
+		else:
+			latencies.seconds.append(time.perf_counter() - start)
+	return latencies
+
+
+def bench(profile: str, args: argparse.Namespace, directory: Path) -> None:
+	url = f"sqlite+libsql:///{directory / f'{profile}.db'}"
+	writer, reader = create_db_engines(url, profile)
+	migrate(writer)
+	seed(writer, args.rows)
+
+	stop = threading.Event()
+	results: list[Latencies] = [Latencies() for _ in range(args.readers + 1)]
+
+	def run(index: int) -> None:
+		if index == 0:
+			results[index] = write_load(writer, stop, args.batch)
+		else:
+			results[index] = read_load(reader, stop)
+
+	threads = [threading.Thread(target=run, args=(i,)) for i in range(args.readers + 1)]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	time.sleep(args.seconds)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	elapsed = time.perf_counter() - start
+
+	reads = Latencies()
+	for result in results[1:]:
+		reads.seconds.extend(result.seconds)
+		reads.errors += result.errors
+
+	print(f"\n{profile} profile, {args.readers} readers, {elapsed:.1f}s")
+	print(f"  {results[0].report('writes', elapsed)}")
+	print(f"  {reads.report('reads', elapsed)}")
+
+	writer.dispose()
+	if reader is not writer:
+		reader.dispose()
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument(
+		"--profile", choices=PROFILES, help="only benchmark this profile"
+	)
+	parser.add_argument("--seconds", type=float, default=10, help="load duration")
+	parser.add_argument("--readers", type=int, default=4, help="query threads")
+	parser.add_argument("--rows", type=int, default=100_000, help="seeded readings")
+	parser.add_argument(
+		"--batch", type=int, default=50, help="readings per ingest batch"
+	)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		for profile in [args.profile] if args.profile else PROFILES:
+			bench(profile, args, Path(directory))
+
+
+if __name__ == "__main__":
+	main()
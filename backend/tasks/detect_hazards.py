@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from os import environ as env
+from typing import TYPE_CHECKING
+
+from aiomqtt import MqttError
+
+from backend.detector import Alert
+from backend.devices import control_topic
+
+if TYPE_CHECKING:
+	from backend.state import AppState
+
+# Broker topic carrying alerts to every worker
+ALERTS_TOPIC = "alerts"
+
+# Whether hazards switch on the buzzer, and the relay for temperature ones
+ALERT_ACTIONS = env.get("ALERT_ACTIONS", "1") != "0"
+
+# Device commands in flight, referenced until they complete
+pending_commands: set[asyncio.Task[None]] = set()
+
+
+def encode_alert(device_id: str, alert: Alert) -> str:
+	return json.dumps(
+		{
+			"type": "alert",
+			"device": device_id,
+			"kind": alert.kind,
+			"field": alert.field,
+			"value": alert.value,
+			"limit": alert.limit,
+			"active": alert.active,
+			"hazard": alert.hazard,
+			"message": alert.message,
+			"timestamp": alert.timestamp.isoformat(),
+		},
+		separators=(",", ":"),
+	)
+
+
+async def trigger_devices(state: AppState, device_id: str, alert: Alert) -> None:
+	topics = [control_topic(device_id, "buzzer")]
+	if alert.field == "temperature" and alert.kind == "threshold":
+		topics.append(control_topic(device_id, "relay"))
+
+	try:
+		await asyncio.gather(*(state.mqtt.publish(topic, True) for topic in topics))
+	except MqttError as e:
+		print(f"Failed to trigger devices of {device_id} for alert: {e}")
+
+
+def handle_alerts(state: AppState, device_id: str, alerts: list[Alert]) -> None:
+	"""
+	Act on freshly detected alerts: switch on the alarm devices of the board
+	that raised them for hazards, and publish every alert to the WebSocket
+	clients of all workers. Devices are never switched off automatically.
+	"""
+	for alert in alerts:
+		print(f"Alert on {device_id}: {alert.message}")
+		state.broker.publish(ALERTS_TOPIC, encode_alert(device_id, alert).encode())
+
+		if ALERT_ACTIONS and alert.hazard:
+			task = asyncio.create_task(trigger_devices(state, device_id, alert))
+			pending_commands.add(task)
+			task.add_done_callback(pending_commands.discard)
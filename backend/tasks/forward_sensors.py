@@ -0,0 +1,242 @@
+"""
+Store and forward of sensor data to a remote database. Ingestion commits to
+the local spool only, and the forwarder ships each device's spooled rows to
+the remote database in id order, advancing the device's cursor in the spool
+once the remote commit succeeded. Failed batches are retried with exponential
+backoff, so readings survive an outage for as long as retention keeps
+unforwarded rows (it never deletes them).
+
+A reading's idempotency key is its primary key, (device_id, timestamp): rows
+the remote database already has are skipped, which makes retrying a batch
+whose commit went through, or forwarding from several spools, safe
+regardless of order.
+"""
+
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta
+from os import environ as env
+from typing import TYPE_CHECKING
+
+from sqlalchemy import Engine, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from backend.devices import known_device_ids
+from backend.models import SensorData, SpoolCursor, to_millis, utc_now
+from backend.rollups import ROLLUPS, update_rollups
+
+if TYPE_CHECKING:
+	from backend.state import AppState
+
+FORWARD_BATCH_SIZE = int(env.get("FORWARD_BATCH_SIZE", "1000"))
+FORWARD_INTERVAL = float(env.get("FORWARD_INTERVAL", "1"))
+FORWARD_MAX_BACKOFF = float(env.get("FORWARD_MAX_BACKOFF", "60"))
+
+# Raw history copied from the remote database into an empty spool
+SPOOL_BOOTSTRAP_DAYS = float(env.get("SPOOL_BOOTSTRAP_DAYS", "1"))
+
+
+# (id, device_id, timestamp, temperature, gas) of a spooled reading
+SpooledRow = tuple[int, str, datetime, float, float]
+
+
+def load_cursors(db: Session) -> dict[str, int]:
+	return dict(
+		db.execute(select(SpoolCursor.device_id, SpoolCursor.forwarded_id))
+		.tuples()
+		.all()
+	)
+
+
+def save_cursors(db: Session, forwarded_ids: dict[str, int]) -> None:
+	stmt = sqlite_insert(SpoolCursor)
+	db.execute(
+		stmt.on_conflict_do_update(
+			index_elements=[SpoolCursor.device_id],
+			set_={
+				"forwarded_id": func.max(
+					SpoolCursor.forwarded_id, stmt.excluded.forwarded_id
+				)
+			},
+		),
+		[
+			{"device_id": device_id, "forwarded_id": forwarded_id}
+			for device_id, forwarded_id in forwarded_ids.items()
+		],
+	)
+
+
+def pending_rows(
+	db: Session, forwarded_ids: dict[str, int], limit: int
+) -> list[SpooledRow]:
+	"""Up to `limit` rows not forwarded yet, each device's in id order."""
+	rows: list[SpooledRow] = []
+	for device_id in known_device_ids(db):
+		if len(rows) >= limit:
+			break
+		rows.extend(
+			db.execute(
+				select(
+					SensorData.id,
+					SensorData.device_id,
+					SensorData.timestamp,
+					SensorData.temperature,
+					SensorData.gas,
+				)
+				.where(
+					SensorData.device_id == device_id,
+					SensorData.id > forwarded_ids.get(device_id, 0),
+				)
+				.order_by(SensorData.id)
+				.limit(limit - len(rows))
+			).tuples()
+		)
+	return rows
+
+
+def push_rows(remote: Engine, rows: list[SpooledRow]) -> int:
+	"""
+	Commit spooled rows to the remote database, skipping those it already
+	has, and fold the new ones into its rollups. Returns the rows inserted.
+	"""
+	with Session(remote) as db, db.begin():
+		inserted = set(
+			db.execute(
+				sqlite_insert(SensorData)
+				.on_conflict_do_nothing()
+				.returning(SensorData.device_id, SensorData.id),
+				[
+					{
+						"device_id": device_id,
+						"timestamp": timestamp,
+						"temperature": temperature,
+						"gas": gas,
+					}
+					for _, device_id, timestamp, temperature, gas in rows
+				],
+			).tuples()
+		)
+		update_rollups(
+			db,
+			(
+				(id, device_id, timestamp, temperature, gas)
+				for id, device_id, timestamp, temperature, gas in rows
+				if (device_id, id) in inserted
+			),
+		)
+		return len(inserted)
+
+
+def bootstrap_spool(local: Engine, remote: Engine) -> None:
+	"""
+	Seed an empty spool with the remote database's rollups and recent raw
+	rows, under their remote ids, so the dashboard starts with history.
+	"""
+	with Session(local) as db:
+		if db.scalar(select(SensorData.id).limit(1)) is not None:
+			return
+
+	since = utc_now() - timedelta(days=SPOOL_BOOTSTRAP_DAYS)
+	with Session(remote) as db:
+		raw = [
+			row._asdict()
+			for row in db.execute(
+				select(SensorData.__table__).where(SensorData.timestamp >= since)
+			)
+		]
+		rollups = {
+			model: [row._asdict() for row in db.execute(select(model.__table__))]
+			for model in ROLLUPS
+		}
+
+	# Idempotent, in case several workers start on an empty spool at once
+	with Session(local) as db, db.begin():
+		if raw:
+			db.execute(insert(SensorData).prefix_with("OR IGNORE"), raw)
+		for model, rows in rollups.items():
+			if rows:
+				db.execute(insert(model).prefix_with("OR IGNORE"), rows)
+
+		# The copied rows are in the remote database already
+		forwarded_ids: dict[str, int] = {}
+		for row in raw:
+			device_id = row["device_id"]
+			forwarded_ids[device_id] = max(
+				forwarded_ids.get(device_id, 0), to_millis(row["timestamp"])
+			)
+		if forwarded_ids:
+			save_cursors(db, forwarded_ids)
+
+	if raw:
+		print(f"Seeded the spool with {len(raw)} readings from the remote database")
+
+
+class SensorForwarder:
+	"""Ships the spool's sensor rows to the remote database in the background"""
+
+	def __init__(
+		self,
+		batch_size: int = FORWARD_BATCH_SIZE,
+		interval: float = FORWARD_INTERVAL,
+	) -> None:
+		self.batch_size = batch_size
+		self.interval = interval
+		self.task: asyncio.Task[None] | None = None
+		# Newest spooled id of each device known to be in the remote database
+		self.forwarded_ids: dict[str, int] | None = None
+		self.forwarded = 0
+		self.skipped = 0
+
+	def start(self, state: AppState) -> None:
+		if self.task is None:
+			self.task = asyncio.create_task(self.run(state))
+
+	async def stop(self) -> None:
+		"""Stop forwarding, unforwarded rows wait in the spool until restart."""
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	async def forward(self, state: AppState) -> int:
+		"""Forward one batch, returns the spooled rows it covered."""
+		assert state.remote_engine is not None
+		if self.forwarded_ids is None:
+			self.forwarded_ids = await state.run_db(load_cursors)
+
+		forwarded_ids = self.forwarded_ids
+		rows = await state.run_db(
+			lambda db: pending_rows(db, forwarded_ids, self.batch_size)
+		)
+		if not rows:
+			return 0
+
+		inserted = await state.run_sync(push_rows, state.remote_engine, rows)
+		advanced = {device_id: id for id, device_id, *_ in rows}
+		await state.run_write(lambda db: save_cursors(db, advanced))
+
+		self.forwarded_ids = {**forwarded_ids, **advanced}
+		self.forwarded += inserted
+		self.skipped += len(rows) - inserted
+		return len(rows)
+
+	async def run(self, state: AppState) -> None:
+		backoff = self.interval
+		while True:
+			try:
+				count = await self.forward(state)
+			except Exception as e:
+				print(f"Failed to forward sensor readings, retrying in {backoff}s: {e}")
+				await asyncio.sleep(backoff)
+				backoff = min(backoff * 2, FORWARD_MAX_BACKOFF)
+				continue
+
+			backoff = self.interval
+			# Catch up on a backlog without waiting between full batches
+			if count < self.batch_size:
+				await asyncio.sleep(self.interval)
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from os import environ as env
+from typing import TYPE_CHECKING
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from backend.models import SensorData, to_millis
+from backend.rollups import update_rollups
+from backend.storage import is_locked
+
+if TYPE_CHECKING:
+	from backend.state import AppState
+
+INGEST_QUEUE_SIZE = int(env.get("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(env.get("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(env.get("INGEST_FLUSH_INTERVAL", "0.25"))
+
+# Attempts at committing a batch while the database is locked, and the delay
+# before the first retry, doubled after each
+INGEST_ATTEMPTS = int(env.get("INGEST_ATTEMPTS", "5"))
+INGEST_RETRY_DELAY = float(env.get("INGEST_RETRY_DELAY", "0.05"))
+
+# Broker topic carrying every committed batch of readings
+READINGS_TOPIC = "readings"
+
+# (id, timestamp, temperature, gas) of a committed reading, the id being the
+# timestamp in epoch milliseconds
+SensorRow = tuple[int, datetime, float, float]
+
+
+@dataclass
+class SensorReading:
+	"""
+	A sensor reading received from MQTT that has not been committed yet, its
+	timestamp stamped by Device.stamp
+	"""
+
+	device_id: str
+	timestamp: datetime
+	temperature: float
+	gas: float
+
+
+@dataclass
+class IngestStats:
+	received: int = 0
+	committed: int = 0
+	dropped: int = 0
+	failed: int = 0
+	retries: int = 0
+	batches: int = 0
+	high_water: int = 0
+
+
+class SensorIngest:
+	"""
+	Bounded ingestion queue that commits sensor readings to the database in
+	batches, flushing when either the batch is full or the flush interval has
+	elapsed since the first pending reading. Committed rows are then published
+	to every worker through the broker, in arrival order.
+	"""
+
+	def __init__(
+		self,
+		queue_size: int = INGEST_QUEUE_SIZE,
+		batch_size: int = INGEST_BATCH_SIZE,
+		flush_interval: float = INGEST_FLUSH_INTERVAL,
+	) -> None:
+		self.queue: asyncio.Queue[SensorReading] = asyncio.Queue(queue_size)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.stats = IngestStats()
+		self.task: asyncio.Task[None] | None = None
+
+	def submit(self, reading: SensorReading) -> bool:
+		"""
+		Enqueue a reading without blocking. Returns False and drops the reading
+		when the queue is full, so a stalled database can't stall MQTT.
+		"""
+		self.stats.received += 1
+		try:
+			self.queue.put_nowait(reading)
+		except asyncio.QueueFull:
+			self.stats.dropped += 1
+			if self.stats.dropped % 100 == 1:
+				print(
+					f"Ingest queue full ({self.queue.maxsize}), "
+					f"dropped {self.stats.dropped} readings so far"
+				)
+			return False
+
+		self.stats.high_water = max(self.stats.high_water, self.queue.qsize())
+		return True
+
+	@property
+	def backlog(self) -> int:
+		return self.queue.qsize()
+
+	def start(self, state: AppState) -> None:
+		self.task = asyncio.create_task(self.run(state))
+
+	async def stop(self, state: AppState) -> None:
+		"""Stop the flush loop and commit whatever is still queued."""
+		if self.task is not None:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+		while not self.queue.empty():
+			await self.flush(state, self.take_pending(self.batch_size))
+
+	def take_pending(self, limit: int) -> list[SensorReading]:
+		batch: list[SensorReading] = []
+		while len(batch) < limit:
+			try:
+				batch.append(self.queue.get_nowait())
+			except asyncio.QueueEmpty:
+				break
+		return batch
+
+	async def next_batch(self) -> list[SensorReading]:
+		batch = [await self.queue.get()]
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + self.flush_interval
+
+		while len(batch) < self.batch_size:
+			batch.extend(self.take_pending(self.batch_size - len(batch)))
+			if len(batch) >= self.batch_size:
+				break
+
+			remaining = deadline - loop.time()
+			if remaining <= 0:
+				break
+
+			try:
+				batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+			except TimeoutError:
+				break
+
+		return batch
+
+	async def run(self, state: AppState) -> None:
+		while True:
+			batch = await self.next_batch()
+			await self.flush(state, batch)
+
+	async def commit(self, state: AppState, batch: list[SensorReading]) -> list[int]:
+		"""Commit a batch, retrying with backoff while the database is locked."""
+		delay = INGEST_RETRY_DELAY
+		for _ in range(INGEST_ATTEMPTS - 1):
+			try:
+				return await state.run_write(lambda db: write_batch(db, batch))
+			except Exception as e:
+				if not is_locked(e):
+					raise
+
+			self.stats.retries += 1
+			await asyncio.sleep(delay)
+			delay *= 2
+
+		return await state.run_write(lambda db: write_batch(db, batch))
+
+	async def flush(self, state: AppState, batch: list[SensorReading]) -> None:
+		if not batch:
+			return
+
+		try:
+			ids = await self.commit(state, batch)
+		except Exception as e:
+			self.stats.failed += len(batch)
+			print(f"Failed to commit {len(batch)} sensor readings: {e}")
+			return
+
+		self.stats.committed += len(ids)
+		self.stats.batches += 1
+
+		rows: dict[str, list[SensorRow]] = {}
+		for id, reading in zip(ids, batch):
+			rows.setdefault(reading.device_id, []).append(
+				(id, reading.timestamp, reading.temperature, reading.gas)
+			)
+
+		state.broker.publish(READINGS_TOPIC, encode_rows(rows))
+
+
+def encode_rows(rows: dict[str, list[SensorRow]]) -> bytes:
+	"""Serialize committed rows grouped by device for the broker."""
+	return json.dumps(
+		{
+			device_id: [
+				[id, timestamp.isoformat(), temperature, gas]
+				for id, timestamp, temperature, gas in device_rows
+			]
+			for device_id, device_rows in rows.items()
+		},
+		separators=(",", ":"),
+	).encode()
+
+
+def decode_rows(payload: bytes) -> dict[str, list[SensorRow]]:
+	return {
+		device_id: [
+			(id, datetime.fromisoformat(timestamp), temperature, gas)
+			for id, timestamp, temperature, gas in device_rows
+		]
+		for device_id, device_rows in json.loads(payload).items()
+	}
+
+
+def write_batch(db: Session, batch: list[SensorReading]) -> list[int]:
+	"""
+	Insert a batch of readings in one statement, and fold them into the rollup
+	tables within the same transaction. Returns the readings' ids.
+	"""
+	db.execute(
+		insert(SensorData),
+		[
+			{
+				"device_id": reading.device_id,
+				"timestamp": reading.timestamp,
+				"temperature": reading.temperature,
+				"gas": reading.gas,
+			}
+			for reading in batch
+		],
+	)
+
+	ids = [to_millis(reading.timestamp) for reading in batch]
+
+	update_rollups(
+		db,
+		(
+			(
+				id,
+				reading.device_id,
+				reading.timestamp,
+				reading.temperature,
+				reading.gas,
+			)
+			for id, reading in zip(ids, batch)
+		),
+	)
+
+	return ids
@@ -1,9 +1,216 @@
-from backend.state import AppState
+"""
+Polls every sensor board on its own schedule. Each device's next request is
+due one interval after the previous deadline, not after the previous request
+completed, so the cadence doesn't drift. The interval adapts to the device's
+recent readings: it backs off towards POLL_MAX_INTERVAL while they are
+stable, and drops to POLL_MIN_INTERVAL as soon as temperature or gas trends
+upwards. Devices start at staggered offsets, so their requests are spread
+over the interval instead of going out in bursts.
 
+Only the broker leader polls. Any worker can switch polling on or off, by
+publishing the request through the broker, and every worker reports the
+status the leader publishes back.
+"""
 
-async def poll_sensors(state: AppState) -> None:
+from __future__ import annotations
+
+import asyncio
+import heapq
+import json
+from contextlib import suppress
+from dataclasses import dataclass, field
+from os import environ as env
+from typing import TYPE_CHECKING
+
+from aiomqtt import MqttError
+
+from backend.detector import ALERT_GAS, ALERT_TEMPERATURE, RISE_GAS, RISE_TEMPERATURE
+from backend.devices import request_topic
+
+if TYPE_CHECKING:
+	from backend.devices import Device
+	from backend.state import AppState
+
+POLL_INTERVAL = float(env.get("POLL_INTERVAL", "3"))
+POLL_MIN_INTERVAL = float(env.get("POLL_MIN_INTERVAL", "0.5"))
+POLL_MAX_INTERVAL = float(env.get("POLL_MAX_INTERVAL", "30"))
+
+# Growth of the interval after every poll with stable readings
+POLL_BACKOFF = 1.5
+
+# Newest readings the trend is fitted on
+POLL_TREND_READINGS = 10
+
+# Trend per minute, as a fraction of the detector's rate-of-rise limits, from
+# which readings count as rising, and under which they count as stable
+POLL_RISING = 0.25
+POLL_STABLE = 0.05
+
+# Broker topics of requests to switch polling on or off, handled by the
+# leader, and of the leader's polling status
+POLL_CONTROL_TOPIC = "poll_control"
+POLL_STATUS_TOPIC = "poll_status"
+
+
+def sensor_trend(device: Device) -> tuple[float, float] | None:
 	"""
-	Poll sensors and store the data in the database.
-	This function is called periodically by the sensor task.
+	Least squares slope per minute of temperature and gas over the newest
+	readings, None when there are too few of them.
 	"""
-	state.mqtt_client.publish("sensor/request", "ON")
+	window = device.buffer.latest(POLL_TREND_READINGS)
+	if window is None or len(window) < 3:
+		return None
+
+	seconds = window.timestamps - window.timestamps.mean()
+	spread = float(seconds @ seconds)
+	if spread == 0:
+		return None
+
+	temperature, gas = (
+		float(seconds @ values) * 60 / spread
+		for values in (window.temperature, window.gas)
+	)
+	return temperature, gas
+
+
+def next_interval(device: Device, interval: float) -> float:
+	"""The interval until the device's next poll, given the current one."""
+	trend = sensor_trend(device)
+	if trend is None:
+		return POLL_INTERVAL
+	temperature_slope, gas_slope = trend
+
+	window = device.buffer.latest(1)
+	assert window is not None
+	hot = window.temperature[-1] >= ALERT_TEMPERATURE or window.gas[-1] >= ALERT_GAS
+
+	if (
+		hot
+		or temperature_slope >= RISE_TEMPERATURE * POLL_RISING
+		or gas_slope >= RISE_GAS * POLL_RISING
+	):
+		return POLL_MIN_INTERVAL
+
+	if (
+		abs(temperature_slope) <= RISE_TEMPERATURE * POLL_STABLE
+		and abs(gas_slope) <= RISE_GAS * POLL_STABLE
+	):
+		return min(max(interval, POLL_INTERVAL) * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+	return POLL_INTERVAL
+
+
+@dataclass
+class PollStatus:
+	"""Polling status of the leader, as last published"""
+
+	running: bool = False
+	intervals: dict[str, float] = field(default_factory=dict)
+
+
+class PollScheduler:
+	"""Sends the poll requests of every known device from a single task"""
+
+	def __init__(self) -> None:
+		self.task: asyncio.Task[None] | None = None
+		self.intervals: dict[str, float] = {}
+		# (deadline, device id) of the next poll of every scheduled device
+		self.queue: list[tuple[float, str]] = []
+		self.requests: set[asyncio.Task[None]] = set()
+		self.status = PollStatus()
+		self.status_published = 0.0
+
+	@property
+	def running(self) -> bool:
+		return self.task is not None
+
+	def set_polling(self, state: AppState, enabled: bool) -> None:
+		"""Ask the leader, whichever worker it is, to start or stop polling."""
+		state.broker.publish(
+			POLL_CONTROL_TOPIC, json.dumps({"enabled": enabled}).encode()
+		)
+
+	def handle_control(self, state: AppState, payload: bytes) -> None:
+		if not state.broker.leader:
+			return
+
+		if json.loads(payload)["enabled"]:
+			self.start(state)
+		else:
+			self.cancel()
+		self.publish_status(state)
+
+	def publish_status(self, state: AppState) -> None:
+		self.status_published = asyncio.get_running_loop().time()
+		state.broker.publish(
+			POLL_STATUS_TOPIC,
+			json.dumps({"running": self.running, "intervals": self.intervals}).encode(),
+		)
+
+	def handle_status(self, payload: bytes) -> None:
+		self.status = PollStatus(**json.loads(payload))
+
+	def start(self, state: AppState) -> None:
+		if self.task is None:
+			self.task = asyncio.create_task(self.run(state))
+
+	def cancel(self) -> asyncio.Task[None] | None:
+		"""Stop polling without waiting, returns the cancelled task."""
+		task, self.task = self.task, None
+		if task is not None:
+			task.cancel()
+
+		self.queue.clear()
+		self.intervals.clear()
+		return task
+
+	async def stop(self) -> None:
+		task = self.cancel()
+		if task is not None:
+			with suppress(asyncio.CancelledError):
+				await task
+
+	def schedule_new(self, state: AppState, now: float) -> None:
+		"""Add devices seen for the first time, staggered over POLL_INTERVAL."""
+		new = [
+			device_id for device_id in state.devices if device_id not in self.intervals
+		]
+		for i, device_id in enumerate(new):
+			self.intervals[device_id] = POLL_INTERVAL
+			heapq.heappush(self.queue, (now + POLL_INTERVAL * i / len(new), device_id))
+
+	async def run(self, state: AppState) -> None:
+		loop = asyncio.get_running_loop()
+		while True:
+			self.schedule_new(state, loop.time())
+			if loop.time() - self.status_published >= POLL_INTERVAL:
+				self.publish_status(state)
+
+			deadline, device_id = self.queue[0]
+			delay = deadline - loop.time()
+			if delay > 0:
+				# Wake up in time to pick up devices that appear meanwhile
+				await asyncio.sleep(min(delay, POLL_INTERVAL))
+				continue
+
+			heapq.heappop(self.queue)
+			request = asyncio.create_task(poll_device(state, device_id))
+			self.requests.add(request)
+			request.add_done_callback(self.requests.discard)
+
+			interval = next_interval(
+				state.devices[device_id], self.intervals[device_id]
+			)
+			self.intervals[device_id] = interval
+
+			# Missed deadlines are skipped rather than sent in a burst
+			heapq.heappush(
+				self.queue, (max(deadline + interval, loop.time()), device_id)
+			)
+
+
+async def poll_device(state: AppState, device_id: str) -> None:
+	try:
+		await state.mqtt.publish(request_topic(device_id), "ON")
+	except MqttError as e:
+		print(f"Failed to poll sensor {device_id}: {e}")
@@ -0,0 +1,103 @@
+"""
+Replay recorded sensor readings through the hazard detector, printing the
+alerts it raises and how long detection takes per reading.
+
+Usage: python -m backend.tasks.replay_detector [--device ID] [--days N] [--csv FILE] [--quiet]
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import time
+from collections import Counter
+from collections.abc import Iterator
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from backend.detector import HazardDetector
+from backend.models import DEFAULT_DEVICE, SensorData, utc_now
+from backend.tasks.detect_hazards import encode_alert
+
+Reading = tuple[datetime, float, float]
+
+
+def read_database(device_id: str, days: float | None) -> Iterator[Reading]:
+	from backend.storage import create_db_engine
+
+	engine = create_db_engine()
+	query = (
+		select(SensorData.timestamp, SensorData.temperature, SensorData.gas)
+		.where(SensorData.device_id == device_id)
+		.order_by(SensorData.timestamp)
+	)
+	if days is not None:
+		query = query.where(SensorData.timestamp >= utc_now() - timedelta(days=days))
+
+	with Session(engine) as db:
+		yield from db.execute(query).yield_per(10000).tuples()
+	engine.dispose()
+
+
+def read_csv(path: str) -> Iterator[Reading]:
+	"""Rows with timestamp (ISO 8601), temperature and gas columns."""
+	with open(path, newline="") as f:
+		for row in csv.DictReader(f):
+			yield (
+				datetime.fromisoformat(row["timestamp"]),
+				float(row["temperature"]),
+				float(row["gas"]),
+			)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument(
+		"--device", default=DEFAULT_DEVICE, help="sensor board to replay"
+	)
+	parser.add_argument("--days", type=float, help="only replay the last N days")
+	parser.add_argument("--csv", help="replay a CSV file instead of the database")
+	parser.add_argument("--quiet", action="store_true", help="don't print each alert")
+	args = parser.parse_args()
+
+	readings = read_csv(args.csv) if args.csv else read_database(args.device, args.days)
+
+	detector = HazardDetector()
+	latencies: list[int] = []
+	kinds: Counter[str] = Counter()
+
+	for timestamp, temperature, gas in readings:
+		# Time from receiving a reading to having its alerts ready to send
+		start = time.perf_counter_ns()
+		alerts = detector.observe(timestamp, temperature, gas)
+		for alert in alerts:
+			encode_alert(args.device, alert)
+		latencies.append(time.perf_counter_ns() - start)
+
+		for alert in alerts:
+			if alert.active:
+				kinds[f"{alert.field} {alert.kind}"] += 1
+			if not args.quiet:
+				print(f"{timestamp.isoformat()} {alert.message}")
+
+	if not latencies:
+		print("No readings to replay")
+		return
+
+	micros = np.array(latencies) / 1000
+	print(f"\nReplayed {len(micros)} readings in {micros.sum() / 1e6:.3f}s")
+	for name, count in sorted(kinds.items()):
+		print(f"  {name}: {count} alerts")
+	print(
+		"Detection latency per reading: "
+		f"p50 {np.percentile(micros, 50):.1f}us, "
+		f"p99 {np.percentile(micros, 99):.1f}us, "
+		f"max {micros.max():.1f}us"
+	)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,189 @@
+"""
+Retention policy for sensor data. Raw readings are kept for a short window,
+rollups for progressively longer ones, and expired rows are deleted in small
+chunks so each delete only holds the write lock briefly.
+
+Usage: python -m backend.tasks.retention [--vacuum]
+"""
+
+from __future__ import annotations
+
+import argparse
+from datetime import datetime, timedelta
+from os import environ as env
+from typing import TYPE_CHECKING
+
+from sqlalchemy import Engine, delete, select
+from sqlalchemy.orm import Session
+
+from backend.devices import known_device_ids
+from backend.models import SensorData, SensorRollup, utc_now
+from backend.rollups import ROLLUPS, to_epoch
+from backend.storage import create_db_engine, is_local
+
+if TYPE_CHECKING:
+	from backend.state import AppState
+
+
+def retention_days(name: str, default: str) -> float | None:
+	"""Read a retention window from the environment, 0 means keep forever."""
+	days = float(env.get(name, default))
+	return days if days > 0 else None
+
+
+RAW_RETENTION_DAYS = retention_days("RAW_RETENTION_DAYS", "30")
+ROLLUP_RETENTION_DAYS: dict[type[SensorRollup], float | None] = {
+	ROLLUPS[0]: retention_days("MINUTE_ROLLUP_RETENTION_DAYS", "180"),
+	ROLLUPS[1]: retention_days("HOUR_ROLLUP_RETENTION_DAYS", "730"),
+	ROLLUPS[2]: retention_days("DAY_ROLLUP_RETENTION_DAYS", "0"),
+}
+
+RETENTION_INTERVAL = float(env.get("RETENTION_INTERVAL", "3600"))
+RETENTION_CHUNK_SIZE = 5000
+
+# Free pages returned to the filesystem per retention run
+VACUUM_PAGES = 2000
+
+
+def raw_cutoff(now: datetime) -> datetime | None:
+	"""Time before which raw rows expire, None when they are kept forever."""
+	if RAW_RETENTION_DAYS is None:
+		return None
+	return now - timedelta(days=RAW_RETENTION_DAYS)
+
+
+def delete_expired_chunk(
+	engine: Engine,
+	device_id: str,
+	cutoff: datetime,
+	keep_after: dict[str, int] | None = None,
+) -> int:
+	"""
+	Delete up to RETENTION_CHUNK_SIZE of a device's oldest raw rows before
+	`cutoff` in a transaction of their own, returns the rows deleted. With
+	`keep_after`, the device's rows with an id above its entry (or any id
+	without one) are kept however old they are.
+	"""
+	# The start of the device's range of the clustered key
+	expired = (
+		select(SensorData.timestamp)
+		.where(SensorData.device_id == device_id, SensorData.timestamp < cutoff)
+		.order_by(SensorData.timestamp)
+		.limit(RETENTION_CHUNK_SIZE)
+	)
+	if keep_after is not None:
+		expired = expired.where(SensorData.id <= keep_after.get(device_id, 0))
+
+	with Session(engine) as db, db.begin():
+		return db.execute(
+			delete(SensorData).where(
+				SensorData.device_id == device_id,
+				SensorData.timestamp.in_(expired.scalar_subquery()),
+			)
+		).rowcount
+
+
+def purge_expired(engine: Engine) -> int:
+	"""Delete expired raw rows and rollup buckets, returns the raw row count."""
+	now = utc_now()
+	cutoff = raw_cutoff(now)
+	deleted = 0
+
+	if cutoff is not None:
+		with Session(engine) as db:
+			device_ids = known_device_ids(db)
+
+		for device_id in device_ids:
+			while True:
+				count = delete_expired_chunk(engine, device_id, cutoff)
+				deleted += count
+				if count < RETENTION_CHUNK_SIZE:
+					break
+
+	purge_rollups(engine, now)
+	return deleted
+
+
+def purge_rollups(engine: Engine, now: datetime) -> None:
+	"""Delete expired rollup buckets, and return free pages to the filesystem."""
+	with Session(engine) as db, db.begin():
+		for model, days in ROLLUP_RETENTION_DAYS.items():
+			if days is not None:
+				cutoff_epoch = to_epoch(now - timedelta(days=days))
+				db.execute(delete(model).where(model.bucket < cutoff_epoch))
+
+	if is_local(engine):
+		# incremental_vacuum returns rows, which libsql refuses in execute()
+		conn = engine.raw_connection()
+		try:
+			conn.cursor().executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+		finally:
+			conn.close()
+
+
+async def purge_local(state: AppState, keep_after: dict[str, int] | None) -> int:
+	"""
+	purge_expired on the app's own database, each chunk a separate job on the
+	writer thread, so ingest batches queued meanwhile commit between chunks.
+	"""
+	now = utc_now()
+	cutoff = raw_cutoff(now)
+	deleted = 0
+
+	if cutoff is not None:
+		for device_id in await state.run_db(known_device_ids):
+			while True:
+				count = await state.run_sync(
+					delete_expired_chunk,
+					state.db_engine,
+					device_id,
+					cutoff,
+					keep_after,
+					write=True,
+				)
+				deleted += count
+				if count < RETENTION_CHUNK_SIZE:
+					break
+
+	await state.run_sync(purge_rollups, state.db_engine, now, write=True)
+	return deleted
+
+
+async def enforce_retention(state: AppState) -> None:
+	try:
+		if state.remote_engine is None:
+			deleted = await purge_local(state, None)
+		else:
+			# Keep spooled rows until they are forwarded
+			await purge_local(state, state.forwarder.forwarded_ids or {})
+			deleted = await state.run_sync(purge_expired, state.remote_engine)
+	except Exception as e:
+		print(f"Failed to enforce sensor data retention: {e}")
+		return
+
+	if deleted:
+		print(f"Deleted {deleted} expired sensor readings")
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument(
+		"--vacuum",
+		action="store_true",
+		help="switch the database to incremental auto-vacuum and compact it",
+	)
+	args = parser.parse_args()
+
+	engine = create_db_engine()
+	print(f"Deleted {purge_expired(engine)} expired sensor readings")
+
+	if args.vacuum and is_local(engine):
+		with engine.connect() as conn:
+			conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+			conn.exec_driver_sql("VACUUM")
+
+	engine.dispose()
+
+
+if __name__ == "__main__":
+	main()
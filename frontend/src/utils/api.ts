@@ -69,3 +69,59 @@ export async function apiPost<T>(
 
 	return response.json()
 }
+
+export type ServerEvent = {
+	event: string
+	data: unknown
+}
+
+/**
+ * POST a JSON body and iterate over the server-sent events of the response
+ * as they arrive.
+ */
+export async function* apiStream(
+	url: string,
+	body?: Record<string, unknown>,
+	options: FetchOptions = {},
+): AsyncGenerator<ServerEvent> {
+	const response = await apiFetch(url, {
+		...options,
+		method: 'POST',
+		headers: {
+			'Content-Type': 'application/json',
+			Accept: 'text/event-stream',
+			...options.headers,
+		},
+		body: body ? JSON.stringify(body) : undefined,
+	})
+
+	if (!response.ok || !response.body) {
+		const errorText = await response.text()
+		throw new Error(errorText || `Request failed: ${response.status} ${response.statusText}`)
+	}
+
+	const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+	let buffer = ''
+
+	while (true) {
+		const { done, value } = await reader.read()
+		if (done) break
+
+		buffer += value
+		let end = buffer.indexOf('\n\n')
+		while (end !== -1) {
+			const block = buffer.slice(0, end)
+			buffer = buffer.slice(end + 2)
+			end = buffer.indexOf('\n\n')
+
+			let event = 'message'
+			let data = ''
+			for (const line of block.split('\n')) {
+				if (line.startsWith('event: ')) event = line.slice(7)
+				else if (line.startsWith('data: ')) data += line.slice(6)
+			}
+
+			yield { event, data: data ? JSON.parse(data) : null }
+		}
+	}
+}